@@ -0,0 +1,79 @@
+import queue
+import socket
+import threading
+import time
+from contextlib import contextmanager
+
+from clickhouse_driver.errors import NetworkError, SocketTimeoutError
+
+# 연결이 끊겼다고 판단할 예외. 이 경우 client 를 버리고 새로 만든다.
+# OSError 전체가 아니라 소켓 오류만 잡는다 (풀 자체의 대기 시간 초과는 다시 시도하지 않는다).
+CONNECTION_ERRORS = (NetworkError, SocketTimeoutError, EOFError, ConnectionError, socket.timeout, socket.gaierror)
+
+
+class PoolExhaustedError(Exception):
+    # timeout 초 안에 빌릴 수 있는 client 가 없을 때. 연결 오류가 아니므로 execute 는 재시도하지 않는다.
+    pass
+
+
+class ClickHousePool:
+    # clickhouse_driver.Client 는 thread-safe 하지 않으므로 스레드마다 하나씩 빌려 쓰고 돌려준다.
+    # - max_size 개 이상은 만들지 않으며, 모두 사용 중이면 timeout 초까지 대기한다.
+    # - health_check_interval 초 이상 쉬었던 client 는 꺼낼 때 SELECT 1 로 확인한다.
+    # - 사용 중 예외가 난 client 는 읽다 만 결과가 남아 있을 수 있으므로 풀로 돌려보내지 않고 닫는다.
+    def __init__(self, factory, max_size: int = 8, timeout: float = 30, health_check_interval: float = 60):
+        self._factory = factory
+        self._timeout = timeout
+        self._health_check_interval = health_check_interval
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._idle = queue.LifoQueue()
+
+    def _checkout(self):
+        while True:
+            try:
+                client, last_used = self._idle.get_nowait()
+            except queue.Empty:
+                return self._factory()
+            if time.monotonic() - last_used < self._health_check_interval:
+                return client
+            try:
+                client.execute("SELECT 1")
+                return client
+            except CONNECTION_ERRORS:
+                client.disconnect()
+
+    @contextmanager
+    def connection(self):
+        if not self._slots.acquire(timeout=self._timeout):
+            raise PoolExhaustedError(f"no ClickHouse connection available within {self._timeout}s")
+        client = None
+        try:
+            client = self._checkout()
+            yield client
+        except BaseException:
+            if client is not None:
+                client.disconnect()
+                client = None
+            raise
+        finally:
+            if client is not None:
+                self._idle.put((client, time.monotonic()))
+            self._slots.release()
+
+    def execute(self, query, *args, retries: int = 1, **kwargs):
+        # 읽기 전용 질의용: 연결 오류면 새 연결로 retries 번 다시 시도한다.
+        for attempt in range(retries + 1):
+            try:
+                with self.connection() as client:
+                    return client.execute(query, *args, **kwargs)
+            except CONNECTION_ERRORS:
+                if attempt == retries:
+                    raise
+
+    def close(self):
+        while True:
+            try:
+                client, _ = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            client.disconnect()
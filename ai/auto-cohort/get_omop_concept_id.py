@@ -2,6 +2,7 @@ import re
 import os
 from dotenv import load_dotenv
 from clickhouse_driver import Client
+from clickhouse_pool import ClickHousePool
 import cohort_json_schema
 from openai import OpenAI
 
@@ -15,12 +16,19 @@ openai_api_key = os.environ.get('OPENAI_COMPATIBLE_API_KEY')
 openai_api_base = os.environ.get('OPENAI_COMPATIBLE_API_BASE')
 model_name = os.environ.get('LLM_MODEL')
 
-# ClickHouse 클라이언트 초기화
-clickhouse_client = Client(
-    host=clickhouse_host,
-    database=clickhouse_database,
-    user=clickhouse_user, 
-    password=clickhouse_password
+# ClickHouse 커넥션 풀 초기화 (Flask 요청 스레드마다 별도 client 사용)
+def create_clickhouse_client():
+    return Client(
+        host=clickhouse_host,
+        database=clickhouse_database,
+        user=clickhouse_user, 
+        password=clickhouse_password
+    )
+
+clickhouse_pool = ClickHousePool(
+    create_clickhouse_client,
+    # .env.example 의 빈 값("CLICKHOUSE_POOL_SIZE=")은 설정하지 않은 것으로 본다
+    max_size=int(os.environ.get('CLICKHOUSE_POOL_SIZE') or 8)
 )
 
 # OpenAI 클라이언트 초기화
@@ -228,7 +236,7 @@ def get_omop_concept_id(term: str, domain_id: str, limit: int = 5, auto_refine:
     # print("\n[실행될 쿼리]:")
     # print(query.replace('%(term)s', f"'%{cleaned_term}%'").replace('%(domain_id)s', f"'{domain_id}'").replace('%(limit)s', str(limit)))
     
-    results = clickhouse_client.execute(query, {
+    results = clickhouse_pool.execute(query, {
         'term': f'%{cleaned_term}%',
         'domain_id': domain_id, 
         'limit': limit
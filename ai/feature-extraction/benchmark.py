@@ -0,0 +1,124 @@
+import argparse
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+from sklearn.preprocessing import MultiLabelBinarizer, normalize as skl_normalize
+
+from scipy.sparse import random as sparse_random
+
+from model import process_boolean_mlb, limit_features, train_model, shap_importance
+from ragged import RaggedArray
+
+
+def make_concept_frame(n_patients: int, n_concepts: int = 50000, mean_len: int = 20, seed: int = 42) -> pd.DataFrame:
+    # 실제 데이터처럼 일부 concept 에 몰리도록 zipf 분포에서 환자별 concept 목록을 만든다.
+    rng = np.random.default_rng(seed)
+    sizes = rng.poisson(mean_len, n_patients)
+    values = (rng.zipf(1.3, int(sizes.sum())) % n_concepts + 1_000_000).astype(np.int64)
+    offsets = np.concatenate([[0], np.cumsum(sizes)])
+    rows = [list(dict.fromkeys(values[s:e].tolist())) for s, e in zip(offsets[:-1], offsets[1:])]
+    return pd.DataFrame({"person_id": np.arange(n_patients), "procedure_ids": rows})
+
+
+def process_boolean_mlb_reference(df, column_name: str, cols_to_drop: list, normalize: bool = False, max_features: int = 30000):
+    # MultiLabelBinarizer 를 쓰던 이전 process_boolean_mlb
+    mlb = MultiLabelBinarizer(sparse_output=True)
+    X = mlb.fit_transform(df[column_name])
+    all_feature_names_numeric = mlb.classes_
+    all_feature_names_as_strings = [str(name) for name in all_feature_names_numeric]
+    cols_to_drop_set = set(cols_to_drop)
+    keep_indices_after_drop = [
+        i for i, name_str in enumerate(all_feature_names_as_strings)
+        if name_str not in cols_to_drop_set
+    ]
+    X = X[:, keep_indices_after_drop]
+    remaining_feature_names = all_feature_names_numeric[keep_indices_after_drop]
+    X, final_mlb_classes = limit_features(X, remaining_feature_names, max_features)
+    if normalize:
+        X = skl_normalize(X, norm='l2', axis=1, copy=False)
+    return X, final_mlb_classes
+
+
+def benchmark_encoding(sizes, reference_limit: int):
+    print(f"{'patients':>10} {'reference(s)':>13} {'numpy(s)':>10} {'same':>6}")
+    for n in sizes:
+        df = make_concept_frame(n)
+        cols_to_drop = [str(c) for c in range(1_000_000, 1_000_050)]
+
+        start = time.perf_counter()
+        X_new, names_new = process_boolean_mlb(df, "procedure_ids", cols_to_drop, normalize=True)
+        new_time = time.perf_counter() - start
+
+        if n <= reference_limit:
+            start = time.perf_counter()
+            X_ref, names_ref = process_boolean_mlb_reference(df, "procedure_ids", cols_to_drop, normalize=True)
+            ref_time = f"{time.perf_counter() - start:.2f}"
+            same = bool(np.array_equal(names_ref, names_new) and abs(X_ref - X_new).max() < 1e-12)
+        else:
+            ref_time, same = "-", "-"
+        print(f"{n:>10} {ref_time:>13} {new_time:>10.2f} {str(same):>6}")
+
+
+def benchmark_ragged(sizes):
+    # list 가 든 object 컬럼 vs RaggedArray 컬럼: 메모리와 pd.concat 시간
+    print(f"{'patients':>10} {'list(MB)':>9} {'ragged(MB)':>11} {'list concat(s)':>15} {'ragged concat(s)':>17}")
+    for n in sizes:
+        df_list = make_concept_frame(n)
+        df_ragged = df_list.assign(procedure_ids=RaggedArray.from_lists(df_list["procedure_ids"]))
+        # memory_usage(deep=True) 는 list 안의 int 객체를 세지 않으므로 직접 더한다
+        list_mb = sum(
+            sys.getsizeof(row) + sum(map(sys.getsizeof, row)) for row in df_list["procedure_ids"]
+        ) / 2 ** 20
+        ragged_mb = df_ragged["procedure_ids"].array.nbytes / 2 ** 20
+
+        start = time.perf_counter()
+        pd.concat([df_list, df_list.iloc[::2]]).reset_index(drop=True)
+        list_time = time.perf_counter() - start
+        start = time.perf_counter()
+        pd.concat([df_ragged, df_ragged.iloc[::2]]).reset_index(drop=True)
+        ragged_time = time.perf_counter() - start
+        print(f"{n:>10} {list_mb:>9.1f} {ragged_mb:>11.1f} {list_time:>15.3f} {ragged_time:>17.3f}")
+
+
+def benchmark_shap(sizes, n_features: int, max_rows: int, n_top: int = 10):
+    # TreeExplainer(전체 학습 행) vs pred_contribs(max_rows 행 표본): 시간과 상위 n_top 일치 수
+    print(f"{'rows':>10} {'tree(s)':>8} {'native(s)':>10} {'top-' + str(n_top) + ' overlap':>15}")
+    for n in sizes:
+        rng = np.random.default_rng(0)
+        X = sparse_random(n, n_features, density=20 / n_features, format="csr", random_state=0, dtype=np.float64)
+        X.data[:] = 1
+        # 앞쪽 몇 개 컬럼만 라벨과 관련 있도록 만든다
+        logit = np.asarray(X[:, :n_top * 2] @ rng.normal(0, 2, n_top * 2)).ravel() - 0.5
+        y = (rng.random(n) < 1 / (1 + np.exp(-logit))).astype(int)
+        model = train_model(X, y)
+
+        start = time.perf_counter()
+        tree_pct = shap_importance(model, X, method="tree")
+        tree_time = time.perf_counter() - start
+        start = time.perf_counter()
+        native_pct = shap_importance(model, X, method="native", max_rows=max_rows)
+        native_time = time.perf_counter() - start
+
+        overlap = len(set(np.argsort(-tree_pct)[:n_top]) & set(np.argsort(-native_pct)[:n_top]))
+        print(f"{n:>10} {tree_time:>8.2f} {native_time:>10.2f} {overlap:>12}/{n_top}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    parser.add_argument("--reference-limit", type=int, default=1_000_000,
+                        help="skip the MultiLabelBinarizer reference above this many patients")
+    parser.add_argument("--shap-sizes", type=int, nargs="+", default=[5_000, 20_000, 50_000])
+    parser.add_argument("--shap-features", type=int, default=2000)
+    parser.add_argument("--shap-max-rows", type=int, default=2000)
+    parser.add_argument("--only", choices=["encoding", "ragged", "shap"], nargs="+",
+                        default=["encoding", "ragged", "shap"])
+    args = parser.parse_args()
+    if "encoding" in args.only:
+        benchmark_encoding(args.sizes, args.reference_limit)
+    if "ragged" in args.only:
+        benchmark_ragged(args.sizes)
+    if "shap" in args.only:
+        benchmark_shap(args.shap_sizes, args.shap_features, args.shap_max_rows)
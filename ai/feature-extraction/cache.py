@@ -0,0 +1,82 @@
+import os
+import threading
+import numpy as np
+
+
+class CohortCache:
+    # execute_query_columnar 결과(dict)를 cohort_id + 버전(데이터 버전 + 쿼리 해시)별 .npz 파일로 저장한다.
+    # - 파일 이름: {name}-{cohort_id}-{version}.npz
+    # - 같은 (name, cohort_id) 의 이전 버전 파일은 새 버전을 저장할 때 지운다.
+    # - 읽을 때마다 mtime 을 갱신하고, 전체 크기가 max_bytes 를 넘으면 오래된 파일부터 지운다 (LRU).
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, name: str, cohort_id: str, version: str) -> str:
+        return os.path.join(self.directory, f"{name}-{cohort_id}-{version}.npz")
+
+    def get(self, name: str, cohort_id: str, version: str):
+        path = self._path(name, cohort_id, version)
+        try:
+            with np.load(path) as npz:
+                files = {key: npz[key] for key in npz.files}
+            os.utime(path)
+        except (FileNotFoundError, ValueError, OSError):
+            return None
+
+        data = {}
+        for key, value in files.items():
+            if key.endswith(".values"):
+                col = key[:-len(".values")]
+                data[col] = (value, files[col + ".offsets"])
+            elif not key.endswith(".offsets"):
+                data[key] = value
+        return data
+
+    def put(self, name: str, cohort_id: str, version: str, data: dict):
+        arrays = {}
+        for col, value in data.items():
+            if isinstance(value, tuple):
+                arrays[col + ".values"], arrays[col + ".offsets"] = value
+            else:
+                arrays[col] = value
+
+        path = self._path(name, cohort_id, version)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_path, path)
+
+        with self._lock:
+            prefix = f"{name}-{cohort_id}-"
+            for entry in os.scandir(self.directory):
+                if entry.name.startswith(prefix) and entry.path != path and entry.name.endswith(".npz"):
+                    self._remove(entry.path)
+            self._evict()
+
+    def _evict(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith(".npz"):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            self._remove(path)
+            total -= size
+
+    @staticmethod
+    def _remove(path: str):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,128 @@
+import numpy as np
+import pandas as pd
+from scipy.stats import norm
+
+
+class ImportanceAccumulator:
+    # epoch 별 importance 를 feature 위치에 맞춘 배열로 누적한다 (Welford 평균 / 분산).
+    # epoch 마다 O(feature 수) 이며, 어떤 epoch 의 결과에 없던 feature 는 그 epoch 을 세지 않는다
+    # (이전의 pd.concat(...).groupby('feature').mean() 과 같은 평균).
+    def __init__(self, feature_names):
+        self.feature_names = np.asarray(feature_names)
+        self._order = np.argsort(self.feature_names, kind="stable")
+        self._sorted_names = self.feature_names[self._order]
+        n = len(self.feature_names)
+        self.count = np.zeros(n, dtype=np.int64)
+        self.mean = np.zeros(n, dtype=np.float64)
+        self._m2 = np.zeros(n, dtype=np.float64)
+        self.n_epochs = 0
+
+    def positions(self, features):
+        features = np.asarray(features)
+        pos = np.minimum(np.searchsorted(self._sorted_names, features), max(len(self._sorted_names) - 1, 0))
+        found = self._sorted_names[pos] == features if len(self._sorted_names) else np.zeros(len(features), dtype=bool)
+        if not found.all():
+            raise KeyError(f"features not in accumulator: {features[~found][:10].tolist()}")
+        return self._order[pos]
+
+    def add(self, features, values):
+        idx = self.positions(features)
+        values = np.asarray(values, dtype=np.float64)
+        self.count[idx] += 1
+        delta = values - self.mean[idx]
+        self.mean[idx] += delta / self.count[idx]
+        self._m2[idx] += delta * (values - self.mean[idx])
+        self.n_epochs += 1
+
+    def variance(self):
+        var = np.zeros_like(self.mean)
+        seen = self.count > 1
+        var[seen] = self._m2[seen] / (self.count[seen] - 1)
+        return var
+
+    def standard_error(self):
+        return np.sqrt(self.variance() / np.maximum(self.count, 1))
+
+    def zero_filled(self):
+        # 결과에 없던 epoch 을 importance 0 으로 센 (평균, 표준오차). 모든 feature 가 n_epochs 개 관측을 갖는다.
+        # feature 별 합 = count * mean, 제곱합 = m2 + count * mean^2 에서 바로 구한다.
+        n = self.n_epochs
+        total = self.count * self.mean
+        mean = total / max(n, 1)
+        m2 = self._m2 + self.count * self.mean ** 2 - n * mean ** 2
+        var = np.maximum(m2, 0) / max(n - 1, 1)
+        return mean, np.sqrt(var / max(n, 1))
+
+    def top(self, k):
+        # 평균이 큰 순서의 위치 (한 번도 나오지 않은 feature 는 제외)
+        seen = np.flatnonzero(self.count > 0)
+        k = min(k, len(seen))
+        if k == 0:
+            return seen
+        top = seen[np.argpartition(-self.mean[seen], k - 1)[:k]]
+        return top[np.argsort(-self.mean[top], kind="stable")]
+
+    def to_frame(self):
+        seen = self.count > 0
+        return pd.DataFrame({
+            "feature": self.feature_names[seen],
+            "importance": self.mean[seen],
+        })
+
+
+class TopKConvergence:
+    # domain 하나의 수렴 상태. 처음 min_epochs_before_check 개 epoch 은 판정하지 않고, 그 뒤로
+    # - 평균 상위 n_top 집합이 min_stable 번 연속 같고, 상위 n_top 의 하한 신뢰 경계가 나머지 feature 의
+    #   상한 신뢰 경계보다 모두 크면 (순위가 통계적으로 갈렸으면) 멈춘다.
+    #   신뢰 경계 = 평균 -/+ z * 표준오차, z 는 비교하는 모든 feature(상위 + 나머지) 구간에 대한
+    #   Bonferroni 보정 양측 confidence 수준. seed 마다 선별 / SHAP 반복으로 결과에 나오는 feature 가
+    #   달라지므로, 경계는 결과에 없던 epoch 을 0 으로 센 값으로 계산한다 (모든 feature 가 같은 관측 수).
+    # - 통계적으로 갈리지 않더라도 같은 집합이 max_same_top_n 번 연속이면 멈춘다 (이전 규칙).
+    def __init__(self, feature_names, n_top=10, max_same_top_n=8, min_epochs_before_check=10,
+                 min_stable=3, confidence=0.95):
+        self.accumulator = ImportanceAccumulator(feature_names)
+        self.n_top = n_top
+        self.max_same_top_n = max_same_top_n
+        self.min_epochs_before_check = min_epochs_before_check
+        self.min_stable = min_stable
+        self.confidence = confidence
+        self.f1_scores = []
+        self.ref_set = None
+        self.stable_count = 0
+
+    @property
+    def avg_importance(self):
+        return self.accumulator.to_frame()
+
+    def separated(self, top):
+        acc = self.accumulator
+        rest = np.ones(len(acc.mean), dtype=bool)
+        rest[top] = False
+        rest &= acc.count > 0
+        if not rest.any():
+            return True
+        if acc.n_epochs < 2:
+            return False
+        z = norm.ppf(1 - (1 - self.confidence) / (2 * (len(top) + int(rest.sum()))))
+        mean, se = acc.zero_filled()
+        lower = (mean[top] - z * se[top]).min()
+        upper = (mean[rest] + z * se[rest]).max()
+        return lower > upper
+
+    def update(self, imp, best_f1) -> bool:
+        self.accumulator.add(imp['feature'].to_numpy(), imp['importance'].to_numpy())
+        self.f1_scores.append(best_f1)
+        if self.accumulator.n_epochs <= self.min_epochs_before_check:
+            return False
+
+        top = self.accumulator.top(self.n_top)
+        curr_set = frozenset(top.tolist())
+        if self.ref_set is None or curr_set != self.ref_set:
+            self.ref_set = curr_set
+            self.stable_count = 1
+        else:
+            self.stable_count += 1
+
+        if self.stable_count >= self.max_same_top_n:
+            return True
+        return self.stable_count >= self.min_stable and self.separated(top)
@@ -1,7 +1,30 @@
 from clickhouse_driver import Client
+from clickhouse_pool import ClickHousePool
+from cache import CohortCache
+from env import env_int, env_str
+from ragged import RaggedArray
+import hashlib
+from itertools import chain
+import numpy as np
 import pandas as pd
 import os
 
+COHORT_COLUMNS = ["person_id", "procedure_ids", "condition_ids", "age", "gender"]
+ARRAY_COLUMNS = ("procedure_ids", "condition_ids")
+DEMOGRAPHIC_COLUMNS = ["person_id", "age", "gender"]
+FETCH_BLOCK_SIZE = 65536
+# domain 이름 -> (사람별 concept 집계 테이블, 컬럼)
+# domain 을 추가하려면 clickhouse.sql 에 같은 형태의 집계 테이블을 만들고 여기에 등록하면 된다.
+CONCEPT_DOMAINS = {
+    "procedure": ("person_procedure_agg", "procedure_ids"),
+    "condition": ("person_condition_agg", "condition_ids"),
+}
+# 캐시된 조회 결과가 읽는 테이블. 이 테이블에 insert 가 일어나면 그 조회의 캐시 버전이 바뀐다.
+# cohort_detail 은 넣지 않는다: 다른 코호트의 insert 로 모든 캐시가 무효화되므로, 이 코호트의 구성원만
+# get_data_version 에서 따로 확인한다.
+DEMOGRAPHIC_TABLES = ("person", "visit_occurrence")
+COHORT_TABLES = DEMOGRAPHIC_TABLES + tuple(table for table, _ in CONCEPT_DOMAINS.values())
+
 
 def get_client():
     client = Client(
@@ -14,11 +37,93 @@ def get_client():
     return client
 
 
-def execute_query(query: str) -> pd.DataFrame:
-    client = get_client()
-    data = client.execute(query)
-    df = pd.DataFrame(data)
-    return df
+pool = ClickHousePool(get_client, max_size=env_int("DB_POOL_SIZE", 8))
+cohort_cache = CohortCache(
+    env_str("COHORT_CACHE_DIR", "/tmp/cohort-cache"),
+    max_bytes=env_int("COHORT_CACHE_MAX_BYTES", 2 * 1024 ** 3),
+)
+
+
+def execute_query_columnar(query: str, columns: list, array_columns=ARRAY_COLUMNS,
+                           block_size: int = FETCH_BLOCK_SIZE, external_tables=None) -> dict:
+    # 결과를 block_size 행 단위로 스트리밍하며 바로 numpy 배열로 변환한다.
+    # 스칼라 컬럼은 1차원 배열, Array 컬럼은 (flat values, offsets) 로 반환하므로
+    # 행마다 python list 를 들고 있는 DataFrame 을 만들지 않는다.
+    parts = {name: [] for name in columns}
+    lengths = {name: [] for name in array_columns}
+    with pool.connection() as client:
+        blocks = client.execute_iter(
+            query, settings={"max_block_size": block_size}, chunk_size=block_size,
+            external_tables=external_tables
+        )
+        for rows in blocks:
+            for name, col in zip(columns, zip(*rows)):
+                if name in lengths:
+                    col = [x or () for x in col]
+                    sizes = np.fromiter(map(len, col), dtype=np.int64, count=len(col))
+                    values = np.fromiter(chain.from_iterable(col), dtype=np.int64, count=int(sizes.sum()))
+                    lengths[name].append(sizes)
+                    parts[name].append(values)
+                else:
+                    values = np.array(col)
+                    if values.dtype == object:
+                        values = np.array(col, dtype=np.float64)  # NULL -> nan
+                    parts[name].append(values)
+
+    result = {}
+    for name in columns:
+        if name in lengths:
+            sizes = np.concatenate(lengths[name]) if lengths[name] else np.zeros(0, dtype=np.int64)
+            offsets = np.zeros(len(sizes) + 1, dtype=np.int64)
+            np.cumsum(sizes, out=offsets[1:])
+            values = np.concatenate(parts[name]) if parts[name] else np.zeros(0, dtype=np.int64)
+            result[name] = (values, offsets)
+        else:
+            result[name] = np.concatenate(parts[name]) if parts[name] else np.zeros(0)
+    return result
+
+
+def get_data_version(cohort_id: str, tables=COHORT_TABLES) -> str:
+    # tables 의 max_block_number 와 이 코호트 구성원(cohort_detail) 으로 만든 버전.
+    # max_block_number 는 insert 때만 커지고 background merge 로는 바뀌지 않는다.
+    tables = ", ".join(f"'{t}'" for t in tables)
+    parts = pool.execute(f"""
+    SELECT   table, max(max_block_number)
+    FROM     system.parts
+    WHERE    database = currentDatabase() AND active AND table IN ({tables})
+    GROUP BY table
+    ORDER BY table
+""")
+    members = pool.execute(f"""
+    SELECT count(), sum(cityHash64(person_id))
+    FROM   cohort_detail
+    WHERE  cohort_id = toUUID('{cohort_id}')
+""")
+    return hashlib.sha1(repr((parts, members)).encode()).hexdigest()[:16]
+
+
+def execute_query_cached(name: str, cohort_id: str, query: str, columns: list,
+                         array_columns=ARRAY_COLUMNS, tables=COHORT_TABLES) -> dict:
+    # 키 = 데이터 버전(query 가 읽는 tables 기준) + 쿼리/컬럼 해시.
+    # 쿼리나 컬럼 구성이 바뀌면 같은 name 이라도 다시 조회한다.
+    query_hash = hashlib.sha1(repr((query, list(columns), sorted(array_columns))).encode()).hexdigest()[:16]
+    version = f"{get_data_version(cohort_id, tables)}-{query_hash}"
+    data = cohort_cache.get(name, cohort_id, version)
+    if data is None:
+        data = execute_query_columnar(query, columns, array_columns)
+        cohort_cache.put(name, cohort_id, version, data)
+    return data
+
+
+def columnar_to_frame(data: dict) -> pd.DataFrame:
+    # Array 컬럼은 (values, offsets) 그대로 RaggedArray 컬럼으로 담는다 (행/원소 단위 python 객체 없음)
+    df = {}
+    for name, col in data.items():
+        if isinstance(col, tuple):
+            df[name] = RaggedArray(*col)
+        else:
+            df[name] = col
+    return pd.DataFrame(df)
 
 
 def generate_cohort_queries_v1(base_cohort_cte: str) -> tuple[str, str]:
@@ -116,31 +221,38 @@ LEFT JOIN patient_details AS pd ON rp.person_id = pd.person_id;
 
 
 def generate_cohort_queries(cohort_id: str) -> tuple[str, str]:
+    # proc_agg / cond_agg 는 매번 전체 fact 테이블을 GROUP BY 하지 않고
+    # person_procedure_agg / person_condition_agg (AggregatingMergeTree, clickhouse.sql 참고) 에서
+    # 코호트에 속한 person_id 의 행만 읽어 병합한다.
     cohort_id = f"toUUID('{cohort_id}')"
     target_query = f"""
 WITH
     target_cohort AS (
-        SELECT person_id
+        SELECT DISTINCT person_id
         FROM   cohort_detail
         WHERE  cohort_id = {cohort_id}
     ),
 
     proc_agg AS (
         SELECT person_id,
-               groupArrayDistinct(procedure_concept_id)  AS procedure_ids
-        FROM   procedure_occurrence
+               groupUniqArrayMerge(procedure_ids)  AS procedure_ids
+        FROM   person_procedure_agg
+        WHERE  person_id IN (SELECT person_id FROM target_cohort)
         GROUP  BY person_id
     ),
     cond_agg AS (
         SELECT person_id,
-               groupArrayDistinct(condition_concept_id)  AS condition_ids
-        FROM   condition_occurrence
+               groupUniqArrayMerge(condition_ids)  AS condition_ids
+        FROM   person_condition_agg
+        WHERE  person_id IN (SELECT person_id FROM target_cohort)
         GROUP  BY person_id
     ),
 
     patient_details AS (
+        -- 방문 단위가 아닌 환자 단위: 첫 입원 방문(9201) 시점의 나이, 입원 방문이 없으면 첫 방문 시점
         SELECT  p.person_id,
-                (toYear(v.visit_start_date) - p.year_of_birth)          AS age,
+                argMin(toYear(v.visit_start_date) - p.year_of_birth,
+                       (v.visit_concept_id != 9201, v.visit_start_date))  AS age,
                 CASE
                     WHEN p.gender_concept_id = 8532 THEN 1     -- Female
                     WHEN p.gender_concept_id = 8507 THEN 2     -- Male
@@ -148,6 +260,7 @@ WITH
                 END                                            AS gender
         FROM person            AS p
         JOIN visit_occurrence  AS v ON v.person_id = p.person_id
+        GROUP BY p.person_id, p.gender_concept_id
     )
 
 SELECT  tc.person_id,
@@ -177,20 +290,24 @@ WITH
 
     proc_agg AS (
         SELECT person_id,
-               groupArrayDistinct(procedure_concept_id)  AS procedure_ids
-        FROM   procedure_occurrence
+               groupUniqArrayMerge(procedure_ids)  AS procedure_ids
+        FROM   person_procedure_agg
+        WHERE  person_id NOT IN (SELECT person_id FROM target_cohort)
         GROUP  BY person_id
     ),
     cond_agg AS (
         SELECT person_id,
-               groupArrayDistinct(condition_concept_id)  AS condition_ids
-        FROM   condition_occurrence
+               groupUniqArrayMerge(condition_ids)  AS condition_ids
+        FROM   person_condition_agg
+        WHERE  person_id NOT IN (SELECT person_id FROM target_cohort)
         GROUP  BY person_id
     ),
 
     patient_details AS (
+        -- 방문 단위가 아닌 환자 단위: 첫 입원 방문(9201) 시점의 나이, 입원 방문이 없으면 첫 방문 시점
         SELECT  p.person_id,
-                (toYear(v.visit_start_date) - p.year_of_birth)          AS age,
+                argMin(toYear(v.visit_start_date) - p.year_of_birth,
+                       (v.visit_concept_id != 9201, v.visit_start_date))  AS age,
                 CASE
                     WHEN p.gender_concept_id = 8532 THEN 1
                     WHEN p.gender_concept_id = 8507 THEN 2
@@ -198,6 +315,7 @@ WITH
                 END                                            AS gender
         FROM person            AS p
         JOIN visit_occurrence  AS v ON v.person_id = p.person_id
+        GROUP BY p.person_id, p.gender_concept_id
     )
 
 SELECT  ntp.person_id,
@@ -214,79 +332,351 @@ LEFT JOIN patient_details AS pd ON ntp.person_id = pd.person_id;
     return target_query, comparator_query
 
 
+def generate_target_demographics_query(cohort_id: str) -> str:
+    cohort_id = f"toUUID('{cohort_id}')"
+    return f"""
+WITH
+    target_cohort AS (
+        SELECT DISTINCT person_id
+        FROM   cohort_detail
+        WHERE  cohort_id = {cohort_id}
+    ),
+
+    patient_details AS (
+        -- 방문 단위가 아닌 환자 단위: 첫 입원 방문(9201) 시점의 나이, 입원 방문이 없으면 첫 방문 시점
+        SELECT  p.person_id,
+                argMin(toYear(v.visit_start_date) - p.year_of_birth,
+                       (v.visit_concept_id != 9201, v.visit_start_date))  AS age,
+                CASE
+                    WHEN p.gender_concept_id = 8532 THEN 1     -- Female
+                    WHEN p.gender_concept_id = 8507 THEN 2     -- Male
+                    ELSE 0
+                END                                            AS gender
+        FROM person            AS p
+        JOIN visit_occurrence  AS v ON v.person_id = p.person_id
+        WHERE p.person_id IN (SELECT person_id FROM target_cohort)
+        GROUP BY p.person_id, p.gender_concept_id
+    )
+
+SELECT  tc.person_id,
+        pd.age,
+        pd.gender
+FROM target_cohort    AS tc
+LEFT JOIN patient_details AS pd ON tc.person_id = pd.person_id;
+"""
+
+
+def generate_comparator_demographics_query(cohort_id: str) -> str:
+    # PSM 은 age, gender 만 사용하므로 비교군 후보 전체에 대해서는 인구학 정보만 가져온다.
+    cohort_id = f"toUUID('{cohort_id}')"
+    return f"""
+WITH
+    target_cohort AS (
+        SELECT person_id
+        FROM   cohort_detail
+        WHERE  cohort_id = {cohort_id}
+    ),
+
+    non_target_patients AS (
+        SELECT person_id
+        FROM   person
+        WHERE  person_id NOT IN (SELECT person_id FROM target_cohort)
+    ),
+
+    patient_details AS (
+        -- 방문 단위가 아닌 환자 단위: 첫 입원 방문(9201) 시점의 나이, 입원 방문이 없으면 첫 방문 시점
+        SELECT  p.person_id,
+                argMin(toYear(v.visit_start_date) - p.year_of_birth,
+                       (v.visit_concept_id != 9201, v.visit_start_date))  AS age,
+                CASE
+                    WHEN p.gender_concept_id = 8532 THEN 1
+                    WHEN p.gender_concept_id = 8507 THEN 2
+                    ELSE 0
+                END                                            AS gender
+        FROM person            AS p
+        JOIN visit_occurrence  AS v ON v.person_id = p.person_id
+        GROUP BY p.person_id, p.gender_concept_id
+    )
+
+SELECT  ntp.person_id,
+        pd.age,
+        pd.gender
+FROM non_target_patients AS ntp
+LEFT JOIN patient_details AS pd ON ntp.person_id = pd.person_id;
+"""
+
+
+def generate_vocabulary_query(domain: str, cols_to_drop=None, max_features: int = None) -> str:
+    # 외부 테이블 job_persons 에 있는 환자들이 가진 concept 의 정렬된 목록 = 컬럼 순서
+    # max_features 가 주어지면 cols_to_drop 을 제외하고, 행 기준(weight = 중복 매칭 수) 등장 빈도 상위
+    # max_features 개만 남긴다. 동률이면 concept_id 가 큰 쪽을 남긴다 (model.limit_features 도 같은 순서로 자른다).
+    table, column = CONCEPT_DOMAINS[domain]
+    drop_clause = ""
+    if cols_to_drop is not None and len(cols_to_drop):
+        drop_ids = ",".join(str(int(c)) for c in cols_to_drop)
+        drop_clause = f"WHERE  c.concept_id NOT IN ({drop_ids})"
+    limit_clause = ""
+    if max_features is not None:
+        limit_clause = f"""ORDER BY freq DESC, concept_id DESC
+    LIMIT  {int(max_features)}"""
+    return f"""
+SELECT   concept_id
+FROM (
+    SELECT c.concept_id        AS concept_id,
+           sum(p.weight)       AS freq
+    FROM (
+        SELECT person_id,
+               arrayJoin(groupUniqArrayMerge({column}))  AS concept_id
+        FROM   {table}
+        WHERE  person_id IN (SELECT person_id FROM job_persons)
+        GROUP  BY person_id
+    ) AS c
+    JOIN   job_persons AS p ON c.person_id = p.person_id
+    {drop_clause}
+    GROUP  BY c.concept_id
+    {limit_clause}
+)
+ORDER BY concept_id;
+"""
+
+
+def generate_encoded_concept_query(domain: str) -> str:
+    # concept_id 를 외부 테이블 job_vocabulary 의 컬럼 번호로 바꿔서 돌려준다.
+    table, column = CONCEPT_DOMAINS[domain]
+    return f"""
+SELECT   c.person_id,
+         groupArray(v.col)  AS cols
+FROM (
+    SELECT person_id,
+           arrayJoin(groupUniqArrayMerge({column}))  AS concept_id
+    FROM   {table}
+    WHERE  person_id IN (SELECT person_id FROM job_persons)
+    GROUP  BY person_id
+) AS c
+JOIN job_vocabulary AS v ON c.concept_id = v.concept_id
+GROUP BY c.person_id;
+"""
+
+
+def generate_stratified_match_query(cohort_id: str, strata, k: int) -> str:
+    # (age, gender) 층마다 대상군 수 * k 명의 비교군을 ClickHouse 안에서 무작위 추출한다.
+    # 후보가 부족한 층은 후보를 반복 추출한 것으로 보고, 반복 횟수를 weight 로 돌려준다
+    # (match_patients(weighted=True) 와 같은 형태).
+    cohort_id = f"toUUID('{cohort_id}')"
+    strata = ",".join(f"({int(age)}, {int(gender)}, {int(count) * k})" for age, gender, count in strata)
+    return f"""
+WITH
+    target_cohort AS (
+        SELECT person_id
+        FROM   cohort_detail
+        WHERE  cohort_id = {cohort_id}
+    ),
+
+    strata AS (
+        SELECT tupleElement(s, 1) AS age,
+               tupleElement(s, 2) AS gender,
+               tupleElement(s, 3) AS need
+        FROM (SELECT arrayJoin([{strata}]) AS s)
+    ),
+
+    candidates AS (
+        SELECT  p.person_id,
+                argMin(toYear(v.visit_start_date) - p.year_of_birth,
+                       (v.visit_concept_id != 9201, v.visit_start_date))  AS age,
+                CASE
+                    WHEN p.gender_concept_id = 8532 THEN 1
+                    WHEN p.gender_concept_id = 8507 THEN 2
+                    ELSE 0
+                END                                            AS gender
+        FROM person            AS p
+        JOIN visit_occurrence  AS v ON v.person_id = p.person_id
+        WHERE p.person_id NOT IN (SELECT person_id FROM target_cohort)
+        GROUP BY p.person_id, p.gender_concept_id
+    ),
+
+    ranked AS (
+        SELECT  c.person_id,
+                c.age,
+                c.gender,
+                s.need,
+                row_number() OVER (PARTITION BY c.age, c.gender ORDER BY rand())  AS rn,
+                count()      OVER (PARTITION BY c.age, c.gender)                  AS cnt
+        FROM candidates  AS c
+        JOIN strata      AS s ON c.age = s.age AND c.gender = s.gender
+    )
+
+SELECT  person_id,
+        age,
+        gender,
+        intDiv(need, cnt) + (rn <= need % cnt)  AS weight
+FROM ranked
+WHERE weight > 0;
+"""
+
+
 def get_drop_id(cohort_id: str) -> tuple[str, str]:
     cohort_id = f"toUUID('{cohort_id}')"
 
-    client = get_client()
     cols_to_drop = f"""
     SELECT toString(concept_id)
     FROM   cohort_concept
     WHERE  cohort_id = {cohort_id}
 """
-    data = client.execute(cols_to_drop)
+    data = pool.execute(cols_to_drop)
     cols_to_drop = [row[0] for row in data]
     return cols_to_drop
 
 
+def check_unique_persons(df: pd.DataFrame, name: str) -> pd.DataFrame:
+    # 환자당 정확히 한 행이어야 한다. 중복 행은 CSR 행렬과 학습 데이터를 부풀린다.
+    duplicated = df['person_id'].duplicated()
+    if duplicated.any():
+        raise ValueError(
+            f"{name}: {int(duplicated.sum())} duplicated person_id rows "
+            f"(e.g. {df.loc[duplicated, 'person_id'].iloc[0]})"
+        )
+    return df
+
+
 def get_target_cohort(cohort_id: str) -> pd.DataFrame:
     target_query, _ = generate_cohort_queries(cohort_id)
-    df = execute_query(target_query)
-    df.rename(columns={
-        0: "person_id",
-        1: "procedure_ids",
-        2: "condition_ids",
-        3: "age",
-        4: "gender"
-    }, inplace=True)
+    df = columnar_to_frame(execute_query_cached("target", cohort_id, target_query, COHORT_COLUMNS))
+    check_unique_persons(df, "target cohort")
     df['label'] = 1
     return df
 
 
 def get_comparator_cohort(cohort_id: str) -> pd.DataFrame:
     _, comparator_query = generate_cohort_queries(cohort_id)
-    df = execute_query(comparator_query)
-    df.rename(columns={
-        0: "person_id",
-        1: "procedure_ids",
-        2: "condition_ids",
-        3: "age",
-        4: "gender"}, inplace=True)
+    df = columnar_to_frame(execute_query_cached("comparator", cohort_id, comparator_query, COHORT_COLUMNS))
+    check_unique_persons(df, "comparator cohort")
     df['label'] = 0
     return df
 
 
-def insert_feature_extraction_data(cohort_id, k, final_proc_importances, final_cond_importances, execution_time, avg_proc_f1, avg_cond_f1):
-    client = get_client()
+def get_target_demographics(cohort_id: str) -> pd.DataFrame:
+    query = generate_target_demographics_query(cohort_id)
+    df = columnar_to_frame(execute_query_cached("target-demographics", cohort_id, query,
+                                                DEMOGRAPHIC_COLUMNS, array_columns=(),
+                                                tables=DEMOGRAPHIC_TABLES))
+    check_unique_persons(df, "target cohort")
+    df['label'] = 1
+    return df
 
-    top_proc_importances = final_proc_importances.head(10)
-    top_cond_importances = final_cond_importances.head(10)
 
+def get_comparator_demographics(cohort_id: str) -> pd.DataFrame:
+    query = generate_comparator_demographics_query(cohort_id)
+    df = columnar_to_frame(execute_query_cached("comparator-demographics", cohort_id, query,
+                                                DEMOGRAPHIC_COLUMNS, array_columns=(),
+                                                tables=DEMOGRAPHIC_TABLES))
+    check_unique_persons(df, "comparator cohort")
+    df['label'] = 0
+    return df
+
+
+def get_stratified_comparators(cohort_id: str, df_target: pd.DataFrame, k: int = 30) -> pd.DataFrame:
+    strata = (
+        df_target.dropna(subset=['age', 'gender'])
+        .groupby(['age', 'gender'])
+        .size()
+        .reset_index()
+        .itertuples(index=False, name=None)
+    )
+    strata = list(strata)
+    if not strata:
+        return pd.DataFrame({'person_id': [], 'age': [], 'gender': [], 'weight': [], 'label': []})
+    query = generate_stratified_match_query(cohort_id, strata, k)
+    df = columnar_to_frame(execute_query_columnar(query, DEMOGRAPHIC_COLUMNS + ['weight'], array_columns=()))
+    df['weight'] = df['weight'].astype(np.float64)
+    df['label'] = 0
+    report_strata_shortfall(strata, df, k)
+    return df
+
+
+def report_strata_shortfall(strata, df: pd.DataFrame, k: int) -> pd.DataFrame:
+    # 층마다 필요한 비교군 수(대상군 수 * k) 대비 서로 다른 후보 수를 비교해, 후보가 모자라 반복 추출했거나
+    # 후보가 아예 없어 매칭되지 않은 층을 출력한다. 모자란 층만 담은 DataFrame 을 돌려준다.
+    need = pd.DataFrame(strata, columns=['age', 'gender', 'targets'])
+    need['need'] = need['targets'] * k
+    found = (
+        df.groupby(['age', 'gender'])
+        .agg(distinct=('person_id', 'size'), matched=('weight', 'sum'))
+        .reset_index()
+    )
+    report = need.merge(found, on=['age', 'gender'], how='left').fillna({'distinct': 0, 'matched': 0})
+    short = report[report['distinct'] < report['need']]
+    if len(short):
+        unmatched = short[short['distinct'] == 0]
+        print(
+            f"stratified matching: {len(short)} of {len(report)} strata have fewer distinct comparators than "
+            f"targets * k ({int(short['need'].sum() - short['distinct'].sum())} comparators short, "
+            f"{int(unmatched['targets'].sum())} targets in {len(unmatched)} strata without any comparator)"
+        )
+        for row in short.itertuples(index=False):
+            print(f"  age={row.age} gender={row.gender}: need {row.need}, "
+                  f"distinct {int(row.distinct)}, matched weight {int(row.matched)}")
+    return short
+
+
+def external_table(name: str, structure: list, columns: list) -> dict:
+    # numpy 컬럼 배열로 external table 을 만든다. 이름은 DB 테이블(OMOP vocabulary 등)과 겹치지 않게 job_ 으로 시작한다.
+    # clickhouse_driver 는 use_numpy 클라이언트에서만 컬럼 단위 external table 을 받고, 그 설정은 결과 읽기까지
+    # 바꾸므로 여기서는 컬럼을 tolist() 로 한 번에 변환해 튜플 행으로 넘긴다 (행마다 dict / int() 변환 없음).
+    return {
+        "name": name,
+        "structure": structure,
+        "data": list(zip(*(np.asarray(col).tolist() for col in columns))),
+    }
+
+
+def get_encoded_concepts(person_ids, domain: str, cols_to_drop=None, max_features: int = None, weights=None) -> tuple:
+    # person_ids (중복 허용) 의 각 행에 대한 CSR (indptr, indices) 와 컬럼별 concept_id 를 반환한다.
+    # cols_to_drop / max_features 를 주면 제외 및 빈도 상위 N 선택을 ClickHouse 에서 먼저 적용한다.
+    # weights 는 행별 중복 매칭 수이며, 없으면 각 행을 1 로 센다.
+    person_ids = np.asarray(person_ids, dtype=np.int64)
+    unique_ids, inverse = np.unique(person_ids, return_inverse=True)
+    row_weights = np.ones(len(person_ids)) if weights is None else np.asarray(weights, dtype=np.float64)
+    weights = np.rint(np.bincount(inverse.ravel(), weights=row_weights, minlength=len(unique_ids)))
+    persons = external_table("job_persons", [("person_id", "Int64"), ("weight", "UInt32")],
+                             [unique_ids, weights.astype(np.int64)])
+
+    vocabulary = execute_query_columnar(
+        generate_vocabulary_query(domain, cols_to_drop, max_features), ["concept_id"],
+        array_columns=(), external_tables=[persons]
+    )["concept_id"].astype(np.int64)
+    vocabulary_table = external_table("job_vocabulary", [("concept_id", "Int64"), ("col", "UInt32")],
+                                      [vocabulary, np.arange(len(vocabulary), dtype=np.int64)])
+    encoded = execute_query_columnar(
+        generate_encoded_concept_query(domain), ["person_id", "cols"],
+        array_columns=("cols",), external_tables=[persons, vocabulary_table]
+    )
+
+    # 조회 결과(환자당 한 행, concept 없는 환자는 없음)를 요청한 행 순서로 펼친다.
+    fetched_ids = encoded["person_id"].astype(np.int64)
+    rows = np.full(len(person_ids), -1, dtype=np.int64)
+    if len(fetched_ids):
+        order = np.argsort(fetched_ids)
+        pos = np.minimum(np.searchsorted(fetched_ids[order], person_ids), len(order) - 1)
+        found = fetched_ids[order[pos]] == person_ids
+        rows[found] = order[pos[found]]
+    encoded_rows = RaggedArray(*encoded["cols"]).take(rows, allow_fill=True)
+    indptr, indices = encoded_rows.offsets, encoded_rows.values.astype(np.int32)
+    return indptr, indices, vocabulary
+
+
+def insert_feature_extraction_data(cohort_id, k, importances: dict, avg_f1: dict, execution_time, run_version, n_top: int = 10):
+    # importances / avg_f1: domain 이름 -> (feature, importance DataFrame) / 평균 f1
+    # 이전 결과를 지우지 않고 새 run_version 으로 한 번에 insert 한다.
+    # 읽는 쪽은 cohort 별 최신 run_version 만 보므로, insert 가 끝나는 순간 새 결과로 바뀐다.
     rows = []
-    for i in range(10):
-        proc_row = top_proc_importances.iloc[i]
-        rank_proc = i + 1  
-        concept_id_proc = int(proc_row['feature'])
-        influence_proc = proc_row['importance']
-        
-        cond_row = top_cond_importances.iloc[i]
-        rank_cond = i + 1  
-        concept_id_cond = int(cond_row['feature'])
-        influence_cond = cond_row['importance']
-
-        rows.append((cohort_id, k, 'procedure', rank_proc, concept_id_proc, influence_proc, int(execution_time), avg_proc_f1))
-        rows.append((cohort_id, k, 'condition', rank_cond, concept_id_cond, influence_cond, int(execution_time), avg_cond_f1))
-    
-    client.execute("""
-        INSERT INTO feature_extraction (cohort_id, multiple, domain_name, rank, concept_id, influence, execution_time, avg_f1_score)
+    for domain, domain_importances in importances.items():
+        top_importances = domain_importances.head(n_top)
+        for i, (concept_id, influence) in enumerate(zip(top_importances['feature'], top_importances['importance'])):
+            rows.append((cohort_id, k, domain, i + 1, int(concept_id), influence, int(execution_time), avg_f1[domain], run_version))
+
+    with pool.connection() as client:
+        client.execute("""
+        INSERT INTO feature_extraction (cohort_id, multiple, domain_name, rank, concept_id, influence, execution_time, avg_f1_score, run_version)
         VALUES
     """, rows)
 
-
-def db_cohort_drop(cohort_id):
-    cohort_id = f"toUUID('{cohort_id}')"
-    client = get_client()
-    client.execute(f"""
-   ALTER TABLE feature_extraction
-   DELETE WHERE cohort_id = {cohort_id}; 
-"""
-                   )
@@ -0,0 +1,24 @@
+import os
+
+
+# .env.example 의 선택 설정은 값이 비어 있는 채로 배포되므로("KEY="), 빈 값은 설정하지 않은 것으로 본다.
+def env_str(name: str, default: str = None) -> str:
+    value = os.getenv(name)
+    if value is None or not value.strip():
+        return default
+    return value.strip()
+
+
+def env_int(name: str, default: int) -> int:
+    value = env_str(name)
+    return default if value is None else int(value)
+
+
+def env_float(name: str, default: float) -> float:
+    value = env_str(name)
+    return default if value is None else float(value)
+
+
+def env_bool(name: str, default: bool) -> bool:
+    value = env_str(name)
+    return default if value is None else value.lower() in ("1", "true", "yes")
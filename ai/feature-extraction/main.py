@@ -1,12 +1,15 @@
 import asyncio
 import json
 import os
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 import numpy as np
 import time
-from sklearn.model_selection import train_test_split
-from model import prepare_two_features, train_model, iterative_shap_train, prepare_psm_features, process_boolean_mlb
-from db import get_target_cohort, get_comparator_cohort, get_drop_id, insert_feature_extraction_data, db_cohort_drop
+from model import prepare_psm_features, process_encoded_concepts
+from epoch_executor import EpochExecutor
+from env import env_int, env_float, env_bool, env_str
+from convergence import TopKConvergence
+from db import CONCEPT_DOMAINS, get_target_demographics, get_comparator_demographics, get_stratified_comparators, get_encoded_concepts, get_drop_id, insert_feature_extraction_data
 import pandas as pd
 import nats
 from flask import Flask, jsonify
@@ -15,6 +18,51 @@ import threading
 
 load_dotenv()
 
+# psm: 비교군 인구학 정보를 모두 가져와 worker 에서 PSM 매칭
+# stratified: ClickHouse 에서 (age, gender) 층별 추출 후 매칭된 id 만 가져옴
+MATCHING_MODE = env_str("MATCHING_MODE", "psm")
+# 제외 concept 과 max_features 빈도 컷을 ClickHouse 에서 먼저 적용해 살아남은 concept 만 전송
+PRUNE_FEATURES_IN_DB = env_bool("PRUNE_FEATURES_IN_DB", True)
+MAX_FEATURES = 30000
+# seed 마다 학습 split 의 chi-square 상위 SCREEN_TOP_M 개 concept 만 남기고 학습한다. 0 이면 선별하지 않는다.
+SCREEN_TOP_M = env_int("SCREEN_TOP_M", 5000)
+# 학습할 concept domain. db.CONCEPT_DOMAINS 에 등록된 것 중에서 고른다 (예: "procedure,condition").
+# 비어 있으면 등록된 domain 전부. 등록되지 않은 이름이 있으면 시작할 때 바로 실패한다.
+def parse_domains(value: str) -> tuple:
+    domains = tuple(dict.fromkeys(d.strip() for d in (value or "").split(",") if d.strip()))
+    if not domains:
+        return tuple(CONCEPT_DOMAINS)
+    unknown = [d for d in domains if d not in CONCEPT_DOMAINS]
+    if unknown:
+        raise ValueError(f"unknown FEATURE_DOMAINS {unknown}; expected some of {list(CONCEPT_DOMAINS)}")
+    return domains
+
+
+DOMAINS = parse_domains(env_str("FEATURE_DOMAINS", ""))
+# 성향 점수 모델: logistic (층화 표본 학습) 또는 sgd (전체 mini-batch 학습)
+PROPENSITY_METHOD = env_str("PROPENSITY_METHOD", "logistic")
+PROPENSITY_MAX_FIT_ROWS = env_int("PROPENSITY_MAX_FIT_ROWS", 200_000)
+# SHAP 계산: native (XGBoost pred_contribs, SHAP_MAX_ROWS 행 표본) 또는 tree (shap.TreeExplainer, 전체 행)
+SHAP_METHOD = env_str("SHAP_METHOD", "native")
+SHAP_MAX_ROWS = env_int("SHAP_MAX_ROWS", 2000)
+# SHAP 행 묶음을 동시에 계산할 스레드 수
+SHAP_N_JOBS = env_int("SHAP_N_JOBS", 1)
+# SHAP 대상: train (최종 모델로 학습 행 설명) 또는 cv (검증 CV 의 fold 모델 재사용, 재학습 없음)
+SHAP_ATTRIBUTION = env_str("SHAP_ATTRIBUTION", "train")
+# 검증 CV 에서 동시에 학습할 fold 수. fold 들은 CPU 수만큼의 스레드를 나눠 쓴다 (XGBoost nthread).
+CV_N_JOBS = env_int("CV_N_JOBS", 1)
+# 0 이면 항상 n_estimators 만큼 학습. 아니면 학습 행 일부를 eval set 으로 두고 early stopping 하며,
+# iterative_shap_train 의 재학습과 CV 는 그 best iteration 만큼만 학습한다.
+# best iteration 이 EARLY_STOPPING_MIN_ROUNDS 보다 작으면 그 tree 수로 다시 학습한다.
+EARLY_STOPPING_ROUNDS = env_int("EARLY_STOPPING_ROUNDS", 10)
+EARLY_STOPPING_MIN_ROUNDS = env_int("EARLY_STOPPING_MIN_ROUNDS", 50)
+# seed 반복을 돌릴 프로세스 수. 0 이면 CPU 수 // THREADS_PER_WORKER, 1 이면 현재 프로세스에서 순서대로
+EPOCH_WORKERS = env_int("EPOCH_WORKERS", 0)
+# 상위 10 집합이 CONVERGENCE_MIN_STABLE 번 연속 같고 나머지와 CONVERGENCE_CONFIDENCE 신뢰 수준으로
+# 갈리면 그 domain 의 반복을 멈춘다 (아니면 8 번 연속 같을 때 멈춤).
+CONVERGENCE_MIN_STABLE = env_int("CONVERGENCE_MIN_STABLE", 3)
+CONVERGENCE_CONFIDENCE = env_float("CONVERGENCE_CONFIDENCE", 0.95)
+
 now_running = False
 
 # Flask app setup
@@ -75,154 +123,95 @@ async def main():
             now_running = False
 
 
+def load_cohort_data(cohort_id, k):
+    # 서로 독립적인 ClickHouse 질의(대상군, 비교군, 제외 concept)를 동시에 보낸다.
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        target_future = executor.submit(get_target_demographics, cohort_id)
+        drop_id_future = executor.submit(get_drop_id, cohort_id)
+        if MATCHING_MODE != "stratified":
+            comp_future = executor.submit(get_comparator_demographics, cohort_id)
+
+        df_target = target_future.result().head(3000)
+        if MATCHING_MODE == "stratified":
+            df_comp = get_stratified_comparators(cohort_id, df_target, k=k)
+        else:
+            df_comp = prepare_psm_features(
+                df_target, comp_future.result(), k=k, normalize=True, weighted=True,
+                propensity_method=PROPENSITY_METHOD, max_fit_rows=PROPENSITY_MAX_FIT_ROWS)
+
+        cols_to_drop = drop_id_future.result()
+    return df_target, df_comp, cols_to_drop
+
+
+def encode_cohort_concepts(person_ids, cols_to_drop, weights=None, domains=DOMAINS):
+    # domain 별 질의는 서로 독립적이므로 동시에 가져온다. domain 이름 -> (CSR, concept_id 목록)
+    pruning = {"cols_to_drop": cols_to_drop, "max_features": MAX_FEATURES} if PRUNE_FEATURES_IN_DB else {}
+    with ThreadPoolExecutor(max_workers=len(domains)) as executor:
+        futures = {
+            domain: executor.submit(get_encoded_concepts, person_ids, domain, weights=weights, **pruning)
+            for domain in domains
+        }
+        return {
+            domain: process_encoded_concepts(
+                *future.result(), cols_to_drop=cols_to_drop, normalize=True, max_features=MAX_FEATURES,
+                sample_weight=weights)
+            for domain, future in futures.items()
+        }
+
+
 def run(cohort_id="0196815f-1e2d-7db9-b630-a747f8393a2d", k=30):
-    db_cohort_drop(cohort_id)
     start_time = time.time()
+    run_version = int(start_time * 1000)
 
-    df_target = get_target_cohort(cohort_id)
-    df_target = df_target.head(3000)
-    df_comp_origin = get_comparator_cohort(cohort_id)
-    cols_to_drop = get_drop_id(cohort_id)
-    df_comp = prepare_psm_features(
-        df_target, df_comp_origin, k=k, normalize=True)
+    df_target, df_comp, cols_to_drop = load_cohort_data(cohort_id, k)
 
-    df_full = pd.concat([df_target, df_comp]).reset_index(drop=True).drop(
+    # 비교군은 중복 매칭이 weight 로 합쳐져 있으므로 행렬은 환자당 한 행, 대상군 weight 는 1
+    df_full = pd.concat([df_target.assign(weight=1.0), df_comp]).reset_index(drop=True).drop(
         columns=[c for c in ['age', 'gender'] if c in df_target.columns]
     )
 
-    for col in ("procedure_ids", "condition_ids"):
-        if col not in df_full.columns:
-            df_full[col] = [[] for _ in range(len(df_full))]
-
-    X_proc_csr, proc_feats = process_boolean_mlb(df_full, "procedure_ids", normalize=True, cols_to_drop=cols_to_drop)
-    X_cond_csr, cond_feats = process_boolean_mlb(df_full, "condition_ids", normalize=True, cols_to_drop=cols_to_drop)
+    w_all = df_full["weight"].to_numpy(dtype=np.float64)
+    encoded = encode_cohort_concepts(df_full["person_id"].to_numpy(), cols_to_drop, w_all)
     y_all = df_full["label"].to_numpy()
 
     epochs = 100
-    proc_importances, cond_importances = [], []
-    proc_f1_scores, cond_f1_scores = [], []
-
-    min_epochs_before_check = 10
-    max_same_top_n = 8
-    n_top = 10
-
-    proc_importances = []
-    cond_importances = []
-    proc_done = cond_done = False
-
-    proc_avg_ref_set = None
-    proc_avg_stable_count = 0
-
-    cond_avg_ref_set = None
-    cond_avg_stable_count = 0
-
-    for seed in range(epochs):
-        current_epoch_num = seed + 1
-
-        if not proc_done:
-            X_tr_proc, X_te_proc, y_tr, y_te = train_test_split(
-                X_proc_csr, y_all, test_size=0.3,
-                stratify=y_all, random_state=seed
-            )
-            m_proc = train_model(X_tr_proc, y_tr)
-            _, _, best_proc, imp_proc = iterative_shap_train(
-                m_proc, X_tr_proc, y_tr, X_te_proc, y_te,
-                feature_names=proc_feats,
-                initial_ratio=0.1,
-                improvement_threshold=0.01,
-                max_iter=3
-            )
-            proc_importances.append(
-                imp_proc.rename(columns={'mean_pct': 'importance'})
-            )
-            proc_f1_scores.append(best_proc)
-
-            avg_proc_imp = (
-                pd.concat(proc_importances)
-                .groupby('feature')['importance']
-                .mean()
-                .reset_index()
-            )
-
-            if current_epoch_num > min_epochs_before_check:
-                top10_avg_proc = (
-                    avg_proc_imp
-                    .sort_values('importance', ascending=False)
-                    .head(n_top)['feature']
-                    .tolist()
-                )
-                curr_proc_avg_set = set(top10_avg_proc)
-                if proc_avg_ref_set is None:
-                    proc_avg_ref_set = curr_proc_avg_set
-                    proc_avg_stable_count = 1
-                else:
-                    if curr_proc_avg_set == proc_avg_ref_set:
-                        proc_avg_stable_count += 1
-                    else:
-                        proc_avg_ref_set = curr_proc_avg_set
-                        proc_avg_stable_count = 1
-
-                if proc_avg_stable_count >= max_same_top_n:
-                    proc_done = True
-
-        if not cond_done:
-            X_tr_cond, X_te_cond, y_tr2, y_te2 = train_test_split(
-                X_cond_csr, y_all, test_size=0.3,
-                stratify=y_all, random_state=seed
-            )
-            m_cond = train_model(X_tr_cond, y_tr2)
-            _, _, best_cond, imp_cond = iterative_shap_train(
-                m_cond, X_tr_cond, y_tr2, X_te_cond, y_te2,
-                feature_names=cond_feats,
-                initial_ratio=0.1,
-                improvement_threshold=0.01,
-                max_iter=3
-            )
-            cond_importances.append(
-                imp_cond.rename(columns={'mean_pct': 'importance'})
-            )
-            cond_f1_scores.append(best_cond)
-
-            avg_cond_imp = (
-                pd.concat(cond_importances)
-                .groupby('feature')['importance']
-                .mean()
-                .reset_index()
-            )
-            if current_epoch_num > min_epochs_before_check:
-                top10_avg_cond = (
-                    avg_cond_imp
-                    .sort_values('importance', ascending=False)
-                    .head(n_top)['feature']
-                    .tolist()
-                )
-                curr_cond_avg_set = set(top10_avg_cond)
-
-                if cond_avg_ref_set is None:
-                    cond_avg_ref_set = curr_cond_avg_set
-                    cond_avg_stable_count = 1
-                else:
-                    if curr_cond_avg_set == cond_avg_ref_set:
-                        cond_avg_stable_count += 1
-                    else:
-                        cond_avg_ref_set = curr_cond_avg_set
-                        cond_avg_stable_count = 1
-
-                if cond_avg_stable_count >= max_same_top_n:
-                    cond_done = True
-
-        if proc_done and cond_done:
-            break
-    avg_proc_imp = avg_proc_imp.sort_values('importance', ascending=False)
-    avg_cond_imp = avg_cond_imp.sort_values('importance', ascending=False)
-    avg_proc_f1 = float(np.mean(proc_f1_scores))
-    avg_cond_f1 = float(np.mean(cond_f1_scores))
+    matrices = {domain: X for domain, (X, _) in encoded.items()}
+    feature_names = {domain: feats for domain, (_, feats) in encoded.items()}
+    tracks = {
+        domain: TopKConvergence(feats, min_stable=CONVERGENCE_MIN_STABLE, confidence=CONVERGENCE_CONFIDENCE)
+        for domain, feats in feature_names.items()
+    }
+
+    options = dict(
+        initial_ratio=0.1,
+        improvement_threshold=0.01,
+        max_iter=3,
+        shap_method=SHAP_METHOD,
+        shap_max_rows=SHAP_MAX_ROWS,
+        shap_n_jobs=SHAP_N_JOBS,
+        attribution=SHAP_ATTRIBUTION,
+        cv_n_jobs=CV_N_JOBS,
+        early_stopping_rounds=EARLY_STOPPING_ROUNDS,
+        early_stopping_min_rounds=EARLY_STOPPING_MIN_ROUNDS,
+        screen_top_m=SCREEN_TOP_M,
+    )
+    # domain 마다 독립된 파이프라인: 각자의 seed 들이 같은 프로세스 풀에서 돌고, 수렴 판정도 따로 한다.
+    # 먼저 수렴한 domain 의 남은 seed 는 취소되어 그 worker 들은 다른 domain 의 seed 를 가져간다.
+    with EpochExecutor(matrices, y_all, w_all, feature_names, options, n_workers=EPOCH_WORKERS) as executor:
+        for domain, seed, (imp, best_f1) in executor.results(epochs):
+            if tracks[domain].update(imp, best_f1):
+                executor.stop(domain)
+
     exec_time = time.time() - start_time
     insert_feature_extraction_data(
-        cohort_id, k, avg_proc_imp, avg_cond_imp,
+        cohort_id, k,
+        importances={
+            domain: track.avg_importance.sort_values('importance', ascending=False)
+            for domain, track in tracks.items()
+        },
+        avg_f1={domain: float(np.mean(track.f1_scores)) for domain, track in tracks.items()},
         execution_time=exec_time,
-        avg_proc_f1=avg_proc_f1,
-        avg_cond_f1=avg_cond_f1
+        run_version=run_version
     )
 
 
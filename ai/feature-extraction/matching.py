@@ -0,0 +1,132 @@
+import numpy as np
+
+KNN_CHUNK_SIZE = 65536
+# without replacement 에서 같은 비교군을 노리는 대상군이 한 round 에 제안할 수 있는 최대 순위
+MAX_GROUP_PROPOSALS = 64
+
+
+def knn_match(target_scores, comp_scores, k: int = 1, caliper: float = None):
+    # 1차원 점수이므로 정렬 + searchsorted 로 각 대상군 주변 2k 개 후보만 보고 k 최근접을 고른다.
+    # 반환: (대상군 수, k) 의 비교군 위치와 거리. caliper 를 넘는 자리는 위치 -1, 거리 inf.
+    target_scores = np.asarray(target_scores, dtype=np.float64)
+    comp_scores = np.asarray(comp_scores, dtype=np.float64)
+    order = np.argsort(comp_scores, kind="stable")
+    sorted_scores = comp_scores[order]
+    n = len(sorted_scores)
+    k = min(k, n)
+    offsets = np.arange(-k, k)
+
+    indices = np.empty((len(target_scores), k), dtype=np.int64)
+    distances = np.empty((len(target_scores), k), dtype=np.float64)
+    for start in range(0, len(target_scores), KNN_CHUNK_SIZE):
+        x = target_scores[start:start + KNN_CHUNK_SIZE]
+        window = np.searchsorted(sorted_scores, x)[:, None] + offsets
+        valid = (window >= 0) & (window < n)
+        window = np.clip(window, 0, n - 1)
+        dist = np.where(valid, np.abs(sorted_scores[window] - x[:, None]), np.inf)
+
+        nearest = np.argpartition(dist, k - 1, axis=1)[:, :k]
+        nearest_dist = np.take_along_axis(dist, nearest, axis=1)
+        by_dist = np.argsort(nearest_dist, axis=1, kind="stable")
+        nearest = np.take_along_axis(nearest, by_dist, axis=1)
+        indices[start:start + len(x)] = order[np.take_along_axis(window, nearest, axis=1)]
+        distances[start:start + len(x)] = np.take_along_axis(nearest_dist, by_dist, axis=1)
+
+    if caliper is not None:
+        indices[distances > caliper] = -1
+        distances[distances > caliper] = np.inf
+    return indices, distances
+
+
+def greedy_match(target_scores, comp_scores, k: int = 1, caliper: float = None):
+    # 비복원 greedy 매칭. k 번의 pass 마다 모든 대상군이 비교군을 하나씩 더 가져간다.
+    # 한 round 에서 각 대상군은 아직 남은 비교군 중 가까운 것을 제안하고, 같은 비교군을 두 명 이상이
+    # 제안하면 거리가 가장 가까운 대상군이 가져간다. 나머지는 다음 round 에 다시 제안한다.
+    # 동점 점수(예: age/gender 층)가 많을 때 한 명씩만 매칭되지 않도록, 같은 최근접을 노리는
+    # 대상군끼리는 r 번째로 가까운 비교군을 나누어 제안한다.
+    # 반환: (대상군 위치, 비교군 위치) 쌍 배열. caliper 안에 남은 비교군이 없는 대상군은 더 받지 않는다.
+    target_scores = np.asarray(target_scores, dtype=np.float64)
+    comp_scores = np.asarray(comp_scores, dtype=np.float64)
+    order = np.argsort(comp_scores, kind="stable")
+    sorted_scores = comp_scores[order]
+    used = np.zeros(len(sorted_scores), dtype=bool)
+    active = np.ones(len(target_scores), dtype=bool)
+    matched_targets, matched_comps = [], []
+
+    for _ in range(k):
+        pending = np.flatnonzero(active)
+        while len(pending) and not used.all():
+            avail = np.flatnonzero(~used)
+            avail_scores = sorted_scores[avail]
+            x = target_scores[pending]
+
+            pos = np.searchsorted(avail_scores, x)
+            left = np.clip(pos - 1, 0, len(avail) - 1)
+            right = np.clip(pos, 0, len(avail) - 1)
+            left_dist = np.abs(x - avail_scores[left])
+            right_dist = np.abs(avail_scores[right] - x)
+            nearest = np.where(left_dist <= right_dist, left, right)
+            nearest_dist = np.minimum(left_dist, right_dist)
+
+            if caliper is not None:
+                out = nearest_dist > caliper
+                active[pending[out]] = False
+                pending, x, pos = pending[~out], x[~out], pos[~out]
+                nearest, nearest_dist = nearest[~out], nearest_dist[~out]
+                if not len(pending):
+                    break
+
+            # 같은 최근접을 노리는 대상군 묶음 안에서 순위 r (가까운 순)
+            group_order = np.lexsort((nearest_dist, nearest))
+            grouped = nearest[group_order]
+            starts = np.r_[0, np.flatnonzero(grouped[1:] != grouped[:-1]) + 1]
+            sizes = np.diff(np.r_[starts, len(grouped)])
+            rank = np.empty(len(pending), dtype=np.int64)
+            rank[group_order] = np.arange(len(pending)) - np.repeat(starts, sizes)
+            width = np.empty(len(pending), dtype=np.int64)
+            width[group_order] = np.minimum(np.repeat(sizes, sizes), MAX_GROUP_PROPOSALS)
+
+            proposing = rank < MAX_GROUP_PROPOSALS
+            member = np.flatnonzero(proposing)
+            rank, width = rank[member], width[member]
+
+            # 각 대상군 주변 2 * width 개 후보 중 rank 번째로 가까운 비교군을 제안한다.
+            cand_offsets = np.zeros(len(member) + 1, dtype=np.int64)
+            np.cumsum(2 * width, out=cand_offsets[1:])
+            owner = np.repeat(np.arange(len(member)), 2 * width)
+            cand = np.repeat(pos[member] - width, 2 * width) + (np.arange(cand_offsets[-1]) - cand_offsets[owner])
+            valid = (cand >= 0) & (cand < len(avail))
+            cand = np.clip(cand, 0, len(avail) - 1)
+            dist = np.where(valid, np.abs(avail_scores[cand] - x[member][owner]), np.inf)
+            by_dist = np.lexsort((dist, owner))
+            pick = by_dist[cand_offsets[:-1] + np.minimum(rank, 2 * width - 1)]
+            proposal, proposal_dist = cand[pick], dist[pick]
+
+            ok = np.isfinite(proposal_dist)
+            if caliper is not None:
+                ok &= proposal_dist <= caliper
+            member, proposal, proposal_dist = member[ok], proposal[ok], proposal_dist[ok]
+
+            # 같은 비교군을 제안한 대상군 중 가장 가까운 쪽이 가져간다.
+            by_dist = np.lexsort((proposal_dist, proposal))
+            _, first = np.unique(proposal[by_dist], return_index=True)
+            winners = by_dist[first]
+
+            comp_pos = avail[proposal[winners]]
+            used[comp_pos] = True
+            matched_targets.append(pending[member[winners]])
+            matched_comps.append(order[comp_pos])
+
+            won = np.zeros(len(pending), dtype=bool)
+            won[member[winners]] = True
+            pending = pending[~won]
+
+        if used.all():
+            break
+
+    if not matched_targets:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    targets = np.concatenate(matched_targets)
+    comps = np.concatenate(matched_comps)
+    by_target = np.argsort(targets, kind="stable")
+    return targets[by_target], comps[by_target]
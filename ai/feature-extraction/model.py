@@ -1,15 +1,20 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 import numpy as np
 from sklearn.feature_extraction import DictVectorizer
 # from sklearn.preprocessing import Normalizer
-from xgboost import XGBClassifier
+from xgboost import XGBClassifier, DMatrix
 import shap
-from sklearn.linear_model import LogisticRegression
-from sklearn.neighbors import NearestNeighbors
-from sklearn.preprocessing import MultiLabelBinarizer
-from sklearn.preprocessing import MultiLabelBinarizer, normalize as skl_normalize
-
-from validation import cross_validate_model
+from sklearn.linear_model import LogisticRegression, SGDClassifier
+from sklearn.model_selection import train_test_split
+from sklearn.pipeline import make_pipeline
+from sklearn.preprocessing import StandardScaler
+from sklearn.preprocessing import normalize as skl_normalize
+
+from validation import cross_validate_model, best_rounds
+from ragged import RaggedArray
+from matching import knn_match, greedy_match
 from scipy.sparse import csr_matrix
 try:
     import torch
@@ -24,83 +29,225 @@ XGB_COMMON_PARAMS = {
     "random_state": 42,
     "tree_method": "gpu_hist" if USE_GPU else "hist",
 }
+# train_model(early_stopping_rounds=...) 에서 eval set 으로 떼어 두는 학습 행 비율
+EVAL_FRACTION = 0.2
+# early stopping 이 이보다 일찍 멈추면 이 tree 수로 다시 학습한다 (신호가 약하면 eval logloss 가 첫 tree 뒤로
+# 나아지지 않아 1 tree 모델이 CV / SHAP 재학습 전체에 쓰이는 것을 막는다).
+EARLY_STOPPING_MIN_ROUNDS = 50
+# 성향 점수 모델: 학습에 쓰는 최대 행 수와 mini-batch / 점수 계산 단위
+PROPENSITY_MAX_FIT_ROWS = 200_000
+PROPENSITY_CHUNK_SIZE = 100_000
+# shap_method="native" 에서 SHAP 값을 계산할 최대 학습 행 수 (무작위 추출)
+SHAP_MAX_ROWS = 2000
+# SHAP 값을 한 번에 계산하는 행 묶음의 최대 크기 (dense float64 기준). 최대 메모리 = 크기 * 동시 스레드 수
+SHAP_CHUNK_BYTES = 256 * 2 ** 20
 from scipy.sparse import csr_matrix
 
+def flatten_concept_lists(series) -> tuple:
+    # 환자별 concept id 목록을 (values, indptr) 로 만든다.
+    # RaggedArray 컬럼이면 복사 없이 그대로, list 컬럼이면 한 번에 펼친다.
+    rows = series.array if isinstance(series.array, RaggedArray) else RaggedArray.from_lists(series)
+    return rows.values[rows.offsets[0]:rows.offsets[-1]], rows.offsets - rows.offsets[0]
+
 def process_boolean_mlb(df, column_name: str, cols_to_drop: list, normalize: bool = False, max_features: int = 30000):
-    mlb = MultiLabelBinarizer(sparse_output=True)
-    X = mlb.fit_transform(df[column_name])
-    all_feature_names_numeric = mlb.classes_ 
-    all_feature_names_as_strings = [str(name) for name in all_feature_names_numeric]
-    cols_to_drop_set = set(cols_to_drop)
-    
-    keep_indices_after_drop = [
-        i for i, name_str in enumerate(all_feature_names_as_strings) 
-        if name_str not in cols_to_drop_set
-    ]
-    
-    X = X[:, keep_indices_after_drop]
-    remaining_feature_names = all_feature_names_numeric[keep_indices_after_drop]
-    
+    values, indptr = flatten_concept_lists(df[column_name])
+    feature_names, indices = np.unique(values, return_inverse=True)
+    return process_encoded_concepts(indptr, indices, feature_names, cols_to_drop, normalize, max_features)
+
+def process_encoded_concepts(indptr, indices, vocabulary, cols_to_drop: list, normalize: bool = False, max_features: int = 30000, sample_weight=None):
+    # (indptr, 컬럼 번호, 컬럼별 concept_id) 로 바로 CSR 을 만든다.
+    # cols_to_drop 은 행렬을 만들기 전에 컬럼 번호를 다시 매겨서 제거한다.
+    # sample_weight 는 행별 중복 매칭 수로, max_features 빈도 컷에서 행을 그만큼 센다.
+    vocabulary = np.asarray(vocabulary, dtype=np.int64)
+    indices = np.asarray(indices, dtype=np.int64)
+    indptr = np.asarray(indptr, dtype=np.int64)
+    n_rows = len(indptr) - 1
+
+    keep = ~np.isin(vocabulary, np.asarray(cols_to_drop).astype(np.int64))
+    if not keep.all():
+        new_index = np.cumsum(keep) - 1
+        kept = keep[indices]
+        row_ids = np.repeat(np.arange(n_rows), np.diff(indptr))
+        indptr = np.zeros(n_rows + 1, dtype=np.int64)
+        np.cumsum(np.bincount(row_ids[kept], minlength=n_rows), out=indptr[1:])
+        indices = new_index[indices[kept]]
+        vocabulary = vocabulary[keep]
+
+    X = csr_matrix(
+        (np.ones(len(indices), dtype=np.int64), indices.astype(np.int32), indptr),
+        shape=(n_rows, len(vocabulary))
+    )
+    X.sum_duplicates()
+    X.data[:] = 1
+    X, feature_names = limit_features(X, vocabulary, max_features, sample_weight)
+
+    if normalize:
+        X = skl_normalize(X, norm='l2', axis=1, copy=False)
+
+    return X, feature_names
+
+def limit_features(X, feature_names, max_features: int = 30000, sample_weight=None):
+    # 컬럼 수가 max_features 를 넘으면 등장 횟수가 1 인 컬럼부터, 그 다음은 적게 등장한 순으로 제거
+    # sample_weight 가 있으면 등장 횟수를 행 가중치 합으로 센다 (중복 행을 펼친 것과 같은 결과).
     n_features = X.shape[1]  # Number of features after dropping specified columns
 
     if n_features > max_features:
-        counts = np.asarray(X.sum(axis=0)).flatten()
+        if sample_weight is None:
+            counts = np.asarray(X.sum(axis=0)).flatten()
+        else:
+            counts = np.asarray(X.T @ np.asarray(sample_weight, dtype=np.float64)).flatten()
         
-        idx_one = np.where(counts == 1)[0]
+        # (등장 횟수, feature 이름) 오름차순으로 제거한다. 동률이면 이름(concept_id)이 작은 쪽부터 지우므로
+        # db.generate_vocabulary_query 의 ORDER BY freq DESC, concept_id DESC LIMIT N 과 같은 컬럼이 남는다.
         remove_count = n_features - max_features
-
-        if len(idx_one) >= remove_count:
-            idx_to_remove_for_max_features = idx_one[:remove_count]
-        else:
-            idx_to_remove_for_max_features = idx_one
-            remaining_to_remove = remove_count - len(idx_one)
-            
-            idx_gt_one = np.where(counts > 1)[0]
-            sorted_indices_gt_one_original = idx_gt_one[np.argsort(counts[idx_gt_one])]
-            
-            idx_to_remove_for_max_features = np.concatenate(
-                [idx_to_remove_for_max_features, sorted_indices_gt_one_original[:remaining_to_remove]]
-            )
+        removal_order = np.lexsort((np.asarray(feature_names), counts))
+        idx_to_remove_for_max_features = removal_order[:remove_count]
 
         idx_to_keep_after_max_features = np.setdiff1d(np.arange(n_features), idx_to_remove_for_max_features)
         
         X = X[:, idx_to_keep_after_max_features]
-        final_mlb_classes = remaining_feature_names[idx_to_keep_after_max_features]
+        feature_names = feature_names[idx_to_keep_after_max_features]
+
+    return X, feature_names
+
+def screen_features(X, y, feature_names, top_m: int, sample_weight=None):
+    # 단변량 사전 선별: 컬럼별 대상군 / 비교군 보유율, log-odds, 2x2 chi-square 를 희소 열 합으로 계산하고
+    # chi-square 상위 top_m 개 컬럼만 고른다 (원래 컬럼 순서 유지). 값이 0 이 아니면 보유로 본다.
+    # 라벨을 쓰므로 학습 split 에만 적용하고, 검증 split 은 같은 위치로 자른다.
+    # 반환: (남길 컬럼 위치, 남긴 컬럼의 통계 DataFrame)
+    y = np.asarray(y).astype(bool)
+    weights = np.ones(X.shape[0]) if sample_weight is None else np.asarray(sample_weight, dtype=np.float64)
+    present = X.astype(bool).astype(np.float64)
+    a = present.T @ (weights * y)      # 대상군 중 보유
+    b = present.T @ (weights * ~y)     # 비교군 중 보유
+    n1, n0 = weights[y].sum(), weights[~y].sum()
+    c, d = n1 - a, n0 - b
+
+    n = n1 + n0
+    denom = (a + b) * (c + d) * n1 * n0
+    chi2 = np.divide(n * (a * d - b * c) ** 2, denom, out=np.zeros_like(a), where=denom > 0)
+    if X.shape[1] <= top_m:
+        keep = np.arange(X.shape[1])
     else:
-        final_mlb_classes = remaining_feature_names
-
-    if normalize:
-        X = skl_normalize(X, norm='l2', axis=1, copy=False)
-        
-    return X, final_mlb_classes
-
-def calculate_propensity_scores(df_target, df_comparator, feature_cols):
-    df_full = pd.concat([df_target[feature_cols], df_comparator[feature_cols]]).reset_index(drop=True)
-    df_full['age'].fillna(df_full['age'].median(), inplace=True)
-    df_full['gender'].fillna(df_full['gender'].mode()[0], inplace=True)
-    y_target = np.ones(len(df_target))
-    y_comparator = np.zeros(len(df_comparator))
-    y_full = np.concatenate([y_target, y_comparator])
-        # 7) 결과 집계
-
+        keep = np.sort(np.argpartition(-chi2, top_m - 1)[:top_m])
+    stats = pd.DataFrame({
+        "feature": np.asarray(feature_names)[keep],
+        "prevalence_target": a[keep] / max(n1, 1),
+        "prevalence_comparator": b[keep] / max(n0, 1),
+        "log_odds": np.log((a[keep] + 0.5) * (d[keep] + 0.5) / ((c[keep] + 0.5) * (b[keep] + 0.5))),
+        "chi2": chi2[keep],
+    })
+    return keep, stats
+
+def calculate_propensity_scores(df_target, df_comparator, feature_cols, method: str = "logistic",
+                                max_fit_rows: int = PROPENSITY_MAX_FIT_ROWS, chunk_size: int = PROPENSITY_CHUNK_SIZE,
+                                random_state: int = 42):
+    # 대상군 = 1, 비교군 = 0 으로 성향 점수 모델을 학습하고 양쪽의 점수를 돌려준다.
+    # method="logistic": 학습 행이 max_fit_rows 를 넘으면 라벨별 층화 표본으로 학습하고,
+    #                    표본 비율 차이만큼 절편을 보정한다 (전체로 학습한 모델과 같은 척도).
+    # method="sgd":      전체 행을 chunk_size 단위 mini-batch 로 SGDClassifier.partial_fit 에 흘려 넣는다.
+    # 점수 계산도 chunk_size 단위로 나눠서 한다.
+    if len(df_target) == 0 or len(df_comparator) == 0:
+        raise ValueError(
+            f"propensity model needs both arms: {len(df_target)} target rows, {len(df_comparator)} comparator rows"
+        )
+    X_target = df_target[feature_cols].to_numpy(dtype=np.float64)
+    X_comp = df_comparator[feature_cols].to_numpy(dtype=np.float64)
+    fill_values = propensity_fill_values(np.vstack([X_target, X_comp]), feature_cols)
+    X_target = fill_missing(X_target, fill_values)
+    X_comp = fill_missing(X_comp, fill_values)
+
+    rng = np.random.default_rng(random_state)
+    start = time.perf_counter()
+    if method == "sgd":
+        model = fit_propensity_sgd(X_target, X_comp, chunk_size, rng)
+        n_fit = len(X_target) + len(X_comp)
+    else:
+        model, n_fit = fit_propensity_subsample(X_target, X_comp, max_fit_rows, rng)
+    print(f"propensity model ({method}) fitted on {n_fit} of {len(X_target) + len(X_comp)} rows "
+          f"in {time.perf_counter() - start:.2f}s")
+
+    return predict_in_chunks(model, X_target, chunk_size), predict_in_chunks(model, X_comp, chunk_size)
+
+def propensity_fill_values(X, feature_cols):
+    # age 는 중앙값, 나머지(gender) 는 최빈값으로 결측을 채운다.
+    fill_values = np.zeros(X.shape[1])
+    for j, col in enumerate(feature_cols):
+        observed = X[~np.isnan(X[:, j]), j]
+        if not len(observed):
+            continue
+        if col == 'age':
+            fill_values[j] = np.median(observed)
+        else:
+            values, counts = np.unique(observed, return_counts=True)
+            fill_values[j] = values[np.argmax(counts)]
+    return fill_values
+
+def fill_missing(X, fill_values):
+    return np.where(np.isnan(X), fill_values, X)
+
+def fit_propensity_subsample(X_target, X_comp, max_fit_rows, rng):
+    # 라벨별로 같은 비율을 넘지 않도록 뽑되, 소수 라벨(보통 대상군)은 최대한 남긴다.
+    n_t, n_c = len(X_target), len(X_comp)
+    if n_t + n_c <= max_fit_rows:
+        take_t, take_c = n_t, n_c
+    else:
+        take_t = min(n_t, max_fit_rows // 2)
+        take_c = min(n_c, max_fit_rows - take_t)
+        take_t = min(n_t, max_fit_rows - take_c)
+    idx_t = rng.choice(n_t, take_t, replace=False) if take_t < n_t else np.arange(n_t)
+    idx_c = rng.choice(n_c, take_c, replace=False) if take_c < n_c else np.arange(n_c)
+
+    X_fit = np.vstack([X_target[idx_t], X_comp[idx_c]])
+    y_fit = np.concatenate([np.ones(take_t), np.zeros(take_c)])
     model = LogisticRegression(solver='liblinear')
-    model.fit(df_full, y_full)
-    
-    propensity_scores = model.predict_proba(df_full)[:, 1]
-    return propensity_scores[:len(df_target)], propensity_scores[len(df_target):]
-
-def match_patients(df_target, df_comparator, target_scores, comp_scores, k=1):
-    nn = NearestNeighbors(n_neighbors=k, algorithm='ball_tree')
-    nn.fit(comp_scores.reshape(-1, 1))
-    distances, indices = nn.kneighbors(target_scores.reshape(-1, 1))
-    return df_comparator.iloc[indices.flatten()]
-
-def prepare_psm_features(df_target, df_comparator, k=30, normalize=True):
+    model.fit(X_fit, y_fit)
+    # case-control 표본 보정: logit(p) = logit(p_sample) - log((take_t / n_t) / (take_c / n_c))
+    model.intercept_ = model.intercept_ - np.log((take_t / n_t) / (take_c / n_c))
+    return model, take_t + take_c
+
+def fit_propensity_sgd(X_target, X_comp, chunk_size, rng):
+    X = np.vstack([X_target, X_comp])
+    y = np.concatenate([np.ones(len(X_target)), np.zeros(len(X_comp))])
+    # SGD 는 입력 척도에 민감하므로 표준화한 뒤 학습한다.
+    model = make_pipeline(StandardScaler(), SGDClassifier(loss='log_loss', random_state=0))
+    scaler, sgd = model.steps[0][1], model.steps[1][1]
+    scaler.fit(X)
+    order = rng.permutation(len(X))
+    for start in range(0, len(X), chunk_size):
+        batch = order[start:start + chunk_size]
+        sgd.partial_fit(scaler.transform(X[batch]), y[batch], classes=np.array([0.0, 1.0]))
+    return model
+
+def predict_in_chunks(model, X, chunk_size):
+    scores = np.empty(len(X), dtype=np.float64)
+    for start in range(0, len(X), chunk_size):
+        scores[start:start + chunk_size] = model.predict_proba(X[start:start + chunk_size])[:, 1]
+    return scores
+
+def match_patients(df_target, df_comparator, target_scores, comp_scores, k=1, caliper=None, replace=True, weighted=False):
+    # replace=True: 대상군마다 k 최근접 (복원), caliper 밖의 이웃은 제외
+    # replace=False: 비복원 greedy 매칭
+    # weighted=True: 여러 번 매칭된 비교군을 한 행으로 합치고 매칭 횟수를 weight 컬럼에 담는다.
+    if replace:
+        indices, _ = knn_match(target_scores, comp_scores, k=k, caliper=caliper)
+        indices = indices.flatten()
+        indices = indices[indices >= 0]
+    else:
+        _, indices = greedy_match(target_scores, comp_scores, k=k, caliper=caliper)
+    if weighted:
+        indices, counts = np.unique(indices, return_counts=True)
+        return df_comparator.iloc[indices].assign(weight=counts.astype(np.float64))
+    return df_comparator.iloc[indices]
+
+def prepare_psm_features(df_target, df_comparator, k=30, normalize=True, caliper=None, replace=True, weighted=False,
+                         propensity_method="logistic", max_fit_rows=PROPENSITY_MAX_FIT_ROWS):
     feature_cols = ['age', 'gender']
     print("start psm")
-    target_scores, comp_scores = calculate_propensity_scores(df_target, df_comparator, feature_cols)
+    target_scores, comp_scores = calculate_propensity_scores(
+        df_target, df_comparator, feature_cols, method=propensity_method, max_fit_rows=max_fit_rows)
     print("match patients start")
-    return match_patients(df_target, df_comparator, target_scores, comp_scores, k=k)
+    return match_patients(df_target, df_comparator, target_scores, comp_scores, k=k, caliper=caliper, replace=replace, weighted=weighted)
 
 def process_ohe_dictvectorizer(df: pd.DataFrame, column_name: str, normalize: bool = False) -> pd.DataFrame:
     vec = DictVectorizer(sparse=True)
@@ -168,11 +315,105 @@ def prepare_two_features(df_target: pd.DataFrame, df_comparator: pd.DataFrame, c
 
     return df_proc, df_cond
 
-def train_model(X, y):
-    model = XGBClassifier(**XGB_COMMON_PARAMS)
-    model.fit(X, y)
+def xgb_params(n_threads=None, **overrides):
+    # n_threads 가 주어지면 XGBoost 스레드 수(n_jobs)로 쓴다. 전역 XGB_COMMON_PARAMS 는 바꾸지 않는다.
+    params = {**XGB_COMMON_PARAMS, **overrides}
+    if n_threads is not None:
+        params["n_jobs"] = n_threads
+    return params
+
+def train_model(X, y, sample_weight=None, early_stopping_rounds=None, eval_fraction=EVAL_FRACTION, random_state=42,
+                n_threads=None, min_rounds=EARLY_STOPPING_MIN_ROUNDS):
+    # early_stopping_rounds 가 주어지면 eval_fraction 만큼을 층화 추출해 eval set 으로 두고,
+    # logloss 가 early_stopping_rounds 번 연속 나아지지 않으면 멈춘다 (최대 n_estimators).
+    # 멈춘 시점은 model.best_iteration 에 남고, 재학습은 best_rounds(model) 만큼만 한다.
+    # best iteration 이 min_rounds 보다 작으면 전체 학습 행으로 min_rounds 개 tree 를 다시 학습해 돌려준다.
+    # n_threads: 이 모델의 XGBoost 스레드 수 (None 이면 XGBoost 기본값)
+    if not early_stopping_rounds:
+        model = XGBClassifier(**xgb_params(n_threads))
+        model.fit(X, y, sample_weight=sample_weight)
+        return model
+
+    weights = np.ones(X.shape[0]) if sample_weight is None else np.asarray(sample_weight, dtype=np.float64)
+    X_fit, X_eval, y_fit, y_eval, w_fit, w_eval = train_test_split(
+        X, y, weights, test_size=eval_fraction, stratify=y, random_state=random_state
+    )
+    model = XGBClassifier(**xgb_params(n_threads), early_stopping_rounds=early_stopping_rounds, eval_metric="logloss")
+    model.fit(X_fit, y_fit, sample_weight=w_fit, eval_set=[(X_eval, y_eval)],
+              sample_weight_eval_set=[w_eval], verbose=False)
+    print(f"early stopping: best iteration {model.best_iteration + 1} / {XGB_COMMON_PARAMS['n_estimators']}")
+    if min_rounds and model.best_iteration + 1 < min_rounds:
+        print(f"early stopping: below {min_rounds} rounds, retraining with {min_rounds}")
+        model = fixed_rounds_model(min_rounds, n_threads)
+        model.fit(X, y, sample_weight=sample_weight)
     return model
 
+def fixed_rounds_model(n_rounds, n_threads=None):
+    return XGBClassifier(**xgb_params(n_threads, n_estimators=n_rounds))
+
+def explained_booster(model):
+    # early stopping 모델은 best iteration 이후의 tree 를 빼고 설명한다 (predict 와 같은 tree 범위).
+    booster = model.get_booster()
+    n_rounds = best_rounds(model)
+    return booster[:n_rounds] if n_rounds < booster.num_boosted_rounds() else booster
+
+def shap_values_tree(model, X):
+    explainer = shap.TreeExplainer(explained_booster(model))
+    shap_vals = explainer.shap_values(X)
+    if isinstance(shap_vals, list):
+        shap_vals = shap_vals[1]
+    return shap_vals
+
+def shap_values_native(model, X):
+    # XGBoost 가 직접 계산하는 SHAP 값 (마지막 열은 bias). CSR 을 그대로 DMatrix 로 넘긴다.
+    contribs = explained_booster(model).predict(DMatrix(X), pred_contribs=True)
+    return contribs[:, :-1]
+
+def shap_importance(model, X, sample_weight=None, method="tree", max_rows=SHAP_MAX_ROWS, random_state=0,
+                    chunk_bytes=SHAP_CHUNK_BYTES, n_jobs=1):
+    # 행별 |SHAP| 비율(%) 의 (가중) 평균. native 는 max_rows 개 행만 무작위로 골라 계산한다.
+    if method == "native" and X.shape[0] > max_rows:
+        rows = np.sort(np.random.default_rng(random_state).choice(X.shape[0], max_rows, replace=False))
+        X = X[rows]
+        sample_weight = None if sample_weight is None else np.asarray(sample_weight)[rows]
+    weights = np.ones(X.shape[0]) if sample_weight is None else np.asarray(sample_weight, dtype=np.float64)
+    return shap_weighted_sum(model, X, weights, method, chunk_bytes, n_jobs) / weights.sum()
+
+def shap_importance_folds(models, folds, X, sample_weight=None, method="tree", max_rows=SHAP_MAX_ROWS,
+                          random_state=0, chunk_bytes=SHAP_CHUNK_BYTES, n_jobs=1):
+    # cross_validate_model(return_models=True) 의 fold 모델로 각자의 검증 행을 설명한다 (재학습 없음).
+    # native 는 fold 마다 max_rows / fold 수 만큼의 행만 쓴다.
+    rng = np.random.default_rng(random_state)
+    weights = np.ones(X.shape[0]) if sample_weight is None else np.asarray(sample_weight, dtype=np.float64)
+    per_fold_rows = max(1, max_rows // len(folds))
+    total, weight_sum = 0, 0
+    for fold_model, rows in zip(models, folds):
+        if method == "native" and len(rows) > per_fold_rows:
+            rows = np.sort(rng.choice(rows, per_fold_rows, replace=False))
+        total = total + shap_weighted_sum(fold_model, X[rows], weights[rows], method, chunk_bytes, n_jobs)
+        weight_sum += weights[rows].sum()
+    return total / weight_sum
+
+def shap_weighted_sum(model, X, weights, method="tree", chunk_bytes=SHAP_CHUNK_BYTES, n_jobs=1):
+    # feature 별 sum(weight * |SHAP| / 행 합계 * 100).
+    # 전체 (행 x feature) SHAP 행렬을 만들지 않도록 chunk_bytes 에 맞춘 행 묶음 단위로 계산해서
+    # feature 별 합만 누적한다. n_jobs > 1 이면 묶음들을 스레드 풀에서 동시에 계산한다.
+    chunk_rows = max(1, chunk_bytes // (8 * (X.shape[1] + 1)))
+    shap_fn = shap_values_native if method == "native" else shap_values_tree
+
+    def chunk_sum(start):
+        shap_vals = np.abs(shap_fn(model, X[start:start + chunk_rows]), dtype=np.float64)
+        total_abs = shap_vals.sum(axis=1)
+        total_abs[total_abs == 0] = 1
+        # rel_pct = |SHAP| / 행 합계 * 100 을 따로 만들지 않고 행 가중치와 합쳐 한 번에 곱한다
+        return (weights[start:start + chunk_rows] * 100 / total_abs) @ shap_vals
+
+    starts = range(0, X.shape[0], chunk_rows)
+    if n_jobs > 1 and len(starts) > 1:
+        with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            return sum(executor.map(chunk_sum, starts))
+    return sum(map(chunk_sum, starts))
+
 def iterative_shap_train(
     model,
     X_train, y_train,
@@ -181,25 +422,43 @@ def iterative_shap_train(
     initial_ratio=0.1,
     ratio_increment=0.2,
     improvement_threshold=0.01,
-    max_iter=3
+    max_iter=3,
+    sample_weight_train=None,
+    sample_weight_val=None,
+    shap_method="tree",
+    shap_max_rows=SHAP_MAX_ROWS,
+    shap_n_jobs=1,
+    attribution="train",
+    cv_n_jobs=1,
+    n_threads=None
 ):
-    best_results  = cross_validate_model(model, X_val, y_val)
+    # sample_weight_*: 행별 중복 매칭 수. 재학습, 검증, SHAP 평균 모두 이 가중치로 계산한다.
+    # shap_method: "tree" (shap.TreeExplainer, 전체 학습 행) / "native" (pred_contribs, shap_max_rows 행)
+    # attribution: "train" (best_model 로 X_train 설명) / "cv" (검증 CV 의 fold 모델로 각 fold 의 X_val 설명)
+    # cv_n_jobs / n_threads: 검증 CV 에서 동시에 학습할 fold 수와 그 fold 들이 나눠 쓸 전체 스레드 수
+    reuse_folds = attribution == "cv"
+
+    def validate(m, X, y):
+        return cross_validate_model(m, X, y, sample_weight=sample_weight_val, n_jobs=cv_n_jobs,
+                                    n_threads=n_threads, return_models=reuse_folds)
+
+    best_results  = validate(model, X_val, y_val)
     best_model    = model
     best_features = feature_names.copy()
     iteration     = 0
     current_ratio = initial_ratio
-    current_feature_names_list = list(best_features)
+    n_initial_features = len(best_features)
     while iteration < max_iter:
-        explainer = shap.TreeExplainer(best_model)
-        shap_vals = explainer.shap_values(X_train)
-        if isinstance(shap_vals, list):
-            shap_vals = shap_vals[1]
-
-        abs_vals  = np.abs(shap_vals)
-        total_abs = abs_vals.sum(axis=1, keepdims=True)
-        total_abs[total_abs == 0] = 1
-        rel_pct   = abs_vals / total_abs * 100
-        mean_pct  = rel_pct.mean(axis=0)
+        if reuse_folds:
+            mean_pct = shap_importance_folds(
+                best_results["models"], best_results["folds"], X_val, sample_weight_val,
+                method=shap_method, max_rows=shap_max_rows, random_state=iteration, n_jobs=shap_n_jobs
+            )
+        else:
+            mean_pct = shap_importance(
+                best_model, X_train, sample_weight_train,
+                method=shap_method, max_rows=shap_max_rows, random_state=iteration, n_jobs=shap_n_jobs
+            )
 
         fi = (
             pd.DataFrame({
@@ -209,17 +468,20 @@ def iterative_shap_train(
             .sort_values("mean_pct", ascending=False)
         )
 
-        top_n = int(len(current_feature_names_list) * current_ratio)
+        top_n = int(n_initial_features * current_ratio)
         top_feats = fi["feature"].iloc[:top_n].tolist() # top_feats는 항상 list
-        
-        top_idx   = [current_feature_names_list.index(f) for f in top_feats]
+
+        # X_train 은 이전 iteration 에서 줄어든 컬럼만 갖고 있으므로 현재 feature_names 기준 위치를 쓴다
+        position = {f: i for i, f in enumerate(feature_names)}
+        top_idx   = [position[f] for f in top_feats]
 
         X_tr_sub = X_train[:, top_idx]
         X_va_sub = X_val[:,   top_idx]
 
-        model_top = XGBClassifier(**XGB_COMMON_PARAMS)
-        model_top.fit(X_tr_sub, y_train)
-        new_results = cross_validate_model(model_top, X_va_sub, y_val)
+        # 주어진 모델이 early stopping 으로 학습됐으면 그 best iteration 만큼만 학습한다
+        model_top = fixed_rounds_model(best_rounds(model), n_threads=model.get_params().get("n_jobs"))
+        model_top.fit(X_tr_sub, y_train, sample_weight=sample_weight_train)
+        new_results = validate(model_top, X_va_sub, y_val)
 
         if new_results["f1"] - best_results["f1"] >= improvement_threshold:
             best_results, best_features, best_model = (
@@ -0,0 +1,124 @@
+import numpy as np
+from itertools import chain
+from pandas.api.extensions import ExtensionArray, ExtensionDtype, register_extension_dtype
+from pandas.api.indexers import check_array_indexer
+
+
+@register_extension_dtype
+class RaggedDtype(ExtensionDtype):
+    name = "ragged[int64]"
+    type = np.ndarray
+    na_value = np.nan
+
+    @classmethod
+    def construct_array_type(cls):
+        return RaggedArray
+
+
+class RaggedArray(ExtensionArray):
+    # 환자별 concept id 목록을 flat values(int64) + offsets(int64) 로 들고 있는 pandas 컬럼.
+    # i 번째 행은 values[offsets[i]:offsets[i + 1]] 이며, 결측 행은 빈 목록으로 취급한다.
+    # pd.concat / iloc / boolean mask / merge 가 모두 values 의 memcpy(또는 gather) 한 번으로 끝난다.
+    def __init__(self, values, offsets):
+        self.values = np.asarray(values, dtype=np.int64)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+
+    @classmethod
+    def from_lists(cls, rows):
+        rows = [x if isinstance(x, (list, tuple, np.ndarray)) else () for x in rows]
+        sizes = np.fromiter(map(len, rows), dtype=np.int64, count=len(rows))
+        offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+        np.cumsum(sizes, out=offsets[1:])
+        values = np.fromiter(chain.from_iterable(rows), dtype=np.int64, count=int(offsets[-1]))
+        return cls(values, offsets)
+
+    @classmethod
+    def _from_sequence(cls, scalars, *, dtype=None, copy=False):
+        if isinstance(scalars, cls):
+            return scalars.copy() if copy else scalars
+        return cls.from_lists(scalars)
+
+    @classmethod
+    def _from_factorized(cls, values, original):
+        return cls.from_lists(values)
+
+    @classmethod
+    def _concat_same_type(cls, to_concat):
+        to_concat = list(to_concat)
+        values = np.concatenate([a.values[a.offsets[0]:a.offsets[-1]] for a in to_concat])
+        offsets = [np.zeros(1, dtype=np.int64)]
+        total = 0
+        for a in to_concat:
+            offsets.append(a.offsets[1:] - a.offsets[0] + total)
+            total += a.offsets[-1] - a.offsets[0]
+        return cls(values, np.concatenate(offsets))
+
+    @property
+    def dtype(self):
+        return RaggedDtype()
+
+    @property
+    def nbytes(self):
+        return self.values.nbytes + self.offsets.nbytes
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, item):
+        if isinstance(item, (int, np.integer)):
+            if item < 0:
+                item += len(self)
+            return self.values[self.offsets[item]:self.offsets[item + 1]]
+        if isinstance(item, slice) and item.step in (None, 1):
+            start, stop, _ = item.indices(len(self))
+            stop = max(start, stop)
+            offsets = self.offsets[start:stop + 1]
+            return type(self)(self.values[offsets[0]:offsets[-1]], offsets - offsets[0])
+        if isinstance(item, slice):
+            return self.take(np.arange(len(self))[item])
+        item = check_array_indexer(self, item)
+        if item.dtype == bool:
+            return self.mask(item)
+        return self.take(item)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __array__(self, dtype=None, copy=None):
+        out = np.empty(len(self), dtype=object)
+        out[:] = list(self)
+        return out
+
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def isna(self):
+        return np.zeros(len(self), dtype=bool)
+
+    def copy(self):
+        return type(self)(self.values.copy(), self.offsets.copy())
+
+    def mask(self, keep):
+        return self.take(np.flatnonzero(keep))
+
+    def take(self, indices, allow_fill=False, fill_value=None):
+        # allow_fill 이면 -1 위치는 빈 목록이 된다 (merge 의 unmatched 행).
+        indices = np.asarray(indices, dtype=np.int64)
+        missing = np.zeros(len(indices), dtype=bool)
+        if allow_fill:
+            if (indices < -1).any():
+                raise ValueError("indices must be >= -1 when allow_fill is True")
+            missing = indices == -1
+        else:
+            indices = np.where(indices < 0, indices + len(self), indices)
+        if len(indices) and ((indices >= len(self)) | (indices < (-1 if allow_fill else 0))).any():
+            raise IndexError("index out of bounds for RaggedArray")
+
+        rows = np.where(missing, 0, indices)
+        starts = self.offsets[rows] if len(self) else np.zeros(len(rows), dtype=np.int64)
+        sizes = np.where(missing, 0, self.offsets[rows + 1] - starts) if len(self) else starts
+        offsets = np.zeros(len(indices) + 1, dtype=np.int64)
+        np.cumsum(sizes, out=offsets[1:])
+        gather = np.repeat(starts - offsets[:-1], sizes) + np.arange(offsets[-1])
+        return type(self)(self.values[gather], offsets)
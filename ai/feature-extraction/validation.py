@@ -1,31 +1,93 @@
 # validation.py
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
-from sklearn.model_selection import StratifiedKFold, cross_validate
+from sklearn.base import clone
+from sklearn.model_selection import StratifiedKFold
 from sklearn.metrics import accuracy_score, roc_auc_score, f1_score
 
+# (seed, cv_splits, y) 별 fold 인덱스. iterative_shap_train 안에서는 같은 y_val 로 여러 번 CV 하므로 재사용된다.
+FOLD_CACHE_SIZE = 32
+_fold_cache = OrderedDict()
+_fold_cache_lock = threading.Lock()
+
+
+def get_folds(y, cv_splits=5, random_state=42):
+    y = np.asarray(y)
+    key = (random_state, cv_splits, len(y), hashlib.sha1(np.ascontiguousarray(y).tobytes()).hexdigest())
+    with _fold_cache_lock:
+        if key in _fold_cache:
+            _fold_cache.move_to_end(key)
+            return _fold_cache[key]
+    cv = StratifiedKFold(n_splits=cv_splits, shuffle=True, random_state=random_state)
+    folds = list(cv.split(np.zeros(len(y)), y))
+    with _fold_cache_lock:
+        _fold_cache[key] = folds
+        while len(_fold_cache) > FOLD_CACHE_SIZE:
+            _fold_cache.popitem(last=False)
+    return folds
+
+
+def best_rounds(model):
+    # early stopping 으로 학습된 XGBoost 모델이면 best iteration 까지의 tree 수, 아니면 n_estimators
+    try:
+        return model.best_iteration + 1
+    except AttributeError:
+        return model.get_params().get("n_estimators")
+
+
+def cross_validate_model(model, X, y, cv_splits=5, sample_weight=None, n_jobs=1, n_threads=None,
+                         random_state=42, return_models=False):
+    # fold 들을 n_jobs 개씩 동시에 학습한다. 전체 스레드 수 n_threads(기본: CPU 수)를 fold 끼리 나눠
+    # 각 fold 모델의 n_jobs(XGBoost nthread) 로 준다.
+    # sample_weight 가 있으면 학습과 점수 모두 같은 가중치를 쓴다.
+    # early stopping 으로 학습된 모델이 오면 fold 모델은 eval set 없이 그 best iteration 만큼만 학습한다.
+    # return_models=True 면 결과에 fold 모델("models") 과 각 fold 의 검증 행 위치("folds") 를 담아 돌려준다.
+    folds = get_folds(y, cv_splits, random_state)
+    if sample_weight is not None:
+        sample_weight = np.asarray(sample_weight, dtype=np.float64)
+    n_jobs = max(1, min(n_jobs, len(folds)))
+    fold_threads = max(1, (n_threads or os.cpu_count() or 1) // n_jobs)
+    fold_params = {}
+    if model.get_params().get("early_stopping_rounds") is not None:
+        fold_params = {"early_stopping_rounds": None, "n_estimators": best_rounds(model)}
+
+    def run_fold(fold):
+        train_idx, test_idx = fold
+        fold_model = clone(model).set_params(**fold_params)
+        if "n_jobs" in fold_model.get_params():
+            fold_model.set_params(n_jobs=fold_threads)
+        train_weight = None if sample_weight is None else sample_weight[train_idx]
+        test_weight = None if sample_weight is None else sample_weight[test_idx]
+        fold_model.fit(X[train_idx], y[train_idx], sample_weight=train_weight)
+        return fold_model, evaluate_model(fold_model, X[test_idx], y[test_idx], sample_weight=test_weight)
+
+    if n_jobs > 1:
+        with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            fold_results = list(executor.map(run_fold, folds))
+    else:
+        fold_results = [run_fold(fold) for fold in folds]
 
-def cross_validate_model(model, X, y, cv_splits=5):
-    cv = StratifiedKFold(n_splits=cv_splits, shuffle=True, random_state=42)
-    scoring = {
-        'accuracy': 'accuracy',
-        'roc_auc': 'roc_auc',
-        'f1': 'f1'
-    }
-    cv_results = cross_validate(model, X, y, cv=cv, scoring=scoring)
     results = {
-        "accuracy": np.mean(cv_results['test_accuracy']),
-        "auc": np.mean(cv_results['test_roc_auc']),
-        "f1": np.mean(cv_results['test_f1'])
+        name: np.mean([scores[name] for _, scores in fold_results])
+        for name in ("accuracy", "auc", "f1")
     }
+    if return_models:
+        results["models"] = [fold_model for fold_model, _ in fold_results]
+        results["folds"] = [test_idx for _, test_idx in folds]
     return results
 
 
-def evaluate_model(model, X_test, y_test):
+def evaluate_model(model, X_test, y_test, sample_weight=None):
     y_pred = model.predict(X_test)
     y_prob = model.predict_proba(X_test)[:, 1]
     results = {
-        "accuracy": accuracy_score(y_test, y_pred),
-        "auc": roc_auc_score(y_test, y_prob),
-        "f1": f1_score(y_test, y_pred)
+        "accuracy": accuracy_score(y_test, y_pred, sample_weight=sample_weight),
+        "auc": roc_auc_score(y_test, y_prob, sample_weight=sample_weight),
+        "f1": f1_score(y_test, y_pred, sample_weight=sample_weight)
     }
     return results
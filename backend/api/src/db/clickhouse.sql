@@ -437,6 +437,7 @@ CREATE TABLE IF NOT EXISTS `statistics_chart` (
 )
 ORDER BY (`statistics_id`, `chart_id`);
 
+-- 기존 배포(run_version 없는 MergeTree)는 migrations/clickhouse-001-feature-extraction-run-version.sql 로 옮긴다.
 CREATE TABLE IF NOT EXISTS `feature_extraction`
 (
     cohort_id   UUID,
@@ -446,8 +447,10 @@ CREATE TABLE IF NOT EXISTS `feature_extraction`
     concept_id  Int64,
     influence Float64,
     execution_time Int64,
-    avg_f1_score Float64
+    avg_f1_score Float64,
+    run_version UInt64                      -- 작업 시작 시각(ms). 읽을 때는 cohort 별 최신 run_version 만 사용
 )
+ENGINE = ReplacingMergeTree(`run_version`)
 ORDER BY (`cohort_id`, `multiple`,`domain_name`, `rank`);
 
 CREATE OR REPLACE FUNCTION _to_date AS (a) -> toDate32(a);
@@ -758,3 +761,45 @@ FROM
 )
 WHERE ordinal = 1;
 
+
+/* Create person_procedure_agg */
+CREATE TABLE IF NOT EXISTS person_procedure_agg (
+    `person_id` Int64,
+    `procedure_ids` AggregateFunction(groupUniqArray, Int64)
+)
+ENGINE = AggregatingMergeTree
+ORDER BY `person_id`;
+CREATE MATERIALIZED VIEW person_procedure_agg_mv
+TO person_procedure_agg
+AS SELECT
+    person_id,
+    groupUniqArrayState(procedure_concept_id) AS procedure_ids
+FROM procedure_occurrence
+GROUP BY person_id;
+INSERT INTO person_procedure_agg
+SELECT
+    person_id,
+    groupUniqArrayState(procedure_concept_id) AS procedure_ids
+FROM procedure_occurrence
+GROUP BY person_id;
+
+/* Create person_condition_agg */
+CREATE TABLE IF NOT EXISTS person_condition_agg (
+    `person_id` Int64,
+    `condition_ids` AggregateFunction(groupUniqArray, Int64)
+)
+ENGINE = AggregatingMergeTree
+ORDER BY `person_id`;
+CREATE MATERIALIZED VIEW person_condition_agg_mv
+TO person_condition_agg
+AS SELECT
+    person_id,
+    groupUniqArrayState(condition_concept_id) AS condition_ids
+FROM condition_occurrence
+GROUP BY person_id;
+INSERT INTO person_condition_agg
+SELECT
+    person_id,
+    groupUniqArrayState(condition_concept_id) AS condition_ids
+FROM condition_occurrence
+GROUP BY person_id;
@@ -0,0 +1,31 @@
+-- feature_extraction 을 MergeTree(run_version 없음) 로 만든 기존 배포를 clickhouse.sql 의 현재 정의로 옮긴다.
+-- clickhouse.sql 은 CREATE TABLE IF NOT EXISTS 라서 이미 있는 테이블은 바뀌지 않는다.
+-- feature-extraction worker 를 멈춘 뒤 한 번 실행한다. 기존 행의 run_version 은 0 이 된다
+-- (API 는 cohort 별 최신 run_version 만 읽으므로 다음 작업 결과가 들어오면 그 결과로 대체된다).
+
+ALTER TABLE `feature_extraction` ADD COLUMN IF NOT EXISTS run_version UInt64 DEFAULT 0;
+
+-- 엔진은 ALTER 로 바꿀 수 없으므로 새 테이블에 복사한 뒤 이름을 바꾼다.
+CREATE TABLE IF NOT EXISTS `feature_extraction_new`
+(
+    cohort_id   UUID,
+    multiple    Int64,
+    domain_name      LowCardinality(String),
+    rank        Int64,
+    concept_id  Int64,
+    influence Float64,
+    execution_time Int64,
+    avg_f1_score Float64,
+    run_version UInt64
+)
+ENGINE = ReplacingMergeTree(`run_version`)
+ORDER BY (`cohort_id`, `multiple`,`domain_name`, `rank`);
+
+INSERT INTO `feature_extraction_new`
+SELECT cohort_id, multiple, domain_name, rank, concept_id, influence, execution_time, avg_f1_score, run_version
+FROM   `feature_extraction`;
+
+RENAME TABLE `feature_extraction` TO `feature_extraction_old`,
+             `feature_extraction_new` TO `feature_extraction`;
+
+DROP TABLE `feature_extraction_old`;
@@ -128,6 +128,7 @@ export interface FeatureExtraction {
   influence: number;
   execution_time: string;
   avg_f1_score: number;
+  run_version: string;
 }
 
 export interface ConditionEra {
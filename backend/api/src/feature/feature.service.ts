@@ -151,10 +151,17 @@ export class FeatureService {
   ): Promise<FeatureStatusResponseDto> {
     const offset = page * limit;
 
+    // Only the latest run is visible; older runs stay until they are merged away
+    const latestRunVersion = getBaseDB()
+      .selectFrom('feature_extraction')
+      .where('cohort_id', '=', cohortId)
+      .select(({ fn }) => fn.max('run_version').as('run_version'));
+
     // Check if features exist for this cohort
     const featuresQuery = getBaseDB()
       .selectFrom('feature_extraction')
       .where('cohort_id', '=', cohortId)
+      .where('feature_extraction.run_version', '=', latestRunVersion)
       .selectAll('feature_extraction')
       .leftJoin(
         'concept',
@@ -170,6 +177,7 @@ export class FeatureService {
     const countQuery = getBaseDB()
       .selectFrom('feature_extraction')
       .where('cohort_id', '=', cohortId)
+      .where('run_version', '=', latestRunVersion)
       .select(({ fn }) => [fn.count('concept_id').as('total')]);
 
     // Execute queries in parallel